@@ -0,0 +1,241 @@
+"""
+Response caches for repeated LLM prompts.
+SemanticCache: in-process exact + embedding-similarity lookups.
+SemanticJudgeCache: SemanticCache of judge evaluations keyed on transcripts.
+RedisResponseCache: exact-prefix responses shared across workers.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import orjson
+from anthropic.types import Message
+
+
+class SemanticCache:
+    """
+    Two-tier cache of LLM responses.
+
+    Tier 1 is an exact hash of the cache key. Tier 2 embeds the prompt text
+    with sentence-transformers and returns a stored response whose prompt has
+    cosine similarity above `threshold` and the same `namespace` (so e.g. a
+    calm persona never receives an angry persona's message). If
+    sentence-transformers is not installed, the cache runs exact-match only.
+
+    Entries are appended to `path` as JSON lines, one per put, and prompts
+    are embedded lazily on the first semantic lookup that needs them.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        threshold: float = 0.95,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2"
+    ):
+        self.path = path
+        self.threshold = threshold
+        self.model_name = model_name
+        self._exact: Dict[str, str] = {}
+        self._namespaces: List[str] = []
+        self._prompts: List[str] = []
+        self._responses: List[str] = []
+        self._embeddings = None  # normalized embeddings of the first len(_embeddings) prompts
+        self._model = None
+        self._semantic_available = True
+        # Serializes model loading and embedding updates across worker threads
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            self._load()
+
+    def get(self, key: tuple, prompt: str, namespace: str = "") -> Optional[str]:
+        """Return a cached response for this key/prompt, or None on miss."""
+        response = self._exact.get(self._hash(key))
+        if response is not None:
+            return response
+        return self._semantic_get(prompt, namespace)
+
+    async def get_async(self, key: tuple, prompt: str, namespace: str = "") -> Optional[str]:
+        """Async version of get; embedding runs in a worker thread so the event loop is not blocked."""
+        response = self._exact.get(self._hash(key))
+        if response is not None:
+            return response
+        if not self._semantic_available or not self._responses:
+            return None
+        return await asyncio.to_thread(self._semantic_get, prompt, namespace)
+
+    def put(self, key: tuple, prompt: str, response: str, namespace: str = ""):
+        """Store a response under both the exact key and the prompt."""
+        hashed = self._hash(key)
+        self._exact[hashed] = response
+        self._namespaces.append(namespace)
+        self._prompts.append(prompt)
+        self._responses.append(response)
+
+        if self.path:
+            with open(self.path, 'ab') as f:
+                f.write(orjson.dumps({
+                    "key": hashed,
+                    "namespace": namespace,
+                    "prompt": prompt,
+                    "response": response
+                }) + b"\n")
+
+    def _semantic_get(self, prompt: str, namespace: str) -> Optional[str]:
+        if not self._semantic_available or not self._responses:
+            return None
+
+        with self._lock:
+            count = len(self._prompts)
+            embeddings = self._embed_prompts(count)
+            query = self._embed([prompt]) if embeddings is not None else None
+        if query is None:
+            return None
+
+        similarities = embeddings @ query[0]
+        for index in similarities.argsort()[::-1]:
+            if similarities[index] < self.threshold:
+                break
+            if self._namespaces[index] == namespace:
+                return self._responses[index]
+        return None
+
+    def _embed_prompts(self, count: int):
+        """Embed any stored prompts not yet embedded, up to count. Caller holds _lock."""
+        done = 0 if self._embeddings is None else len(self._embeddings)
+        if done < count:
+            embedding = self._embed(self._prompts[done:count])
+            if embedding is None:
+                return None
+            import numpy as np
+
+            self._embeddings = embedding if self._embeddings is None else np.vstack([self._embeddings, embedding])
+        return self._embeddings[:count]
+
+    def _hash(self, key: tuple) -> str:
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def _embed(self, texts: List[str]):
+        """Embed texts as normalized vectors, or None if embeddings are unavailable."""
+        if not self._semantic_available:
+            return None
+
+        if self._model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                self._semantic_available = False
+                return None
+            self._model = SentenceTransformer(self.model_name)
+
+        return self._model.encode(texts, normalize_embeddings=True)
+
+    def _load(self):
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # A partial last line from an interrupted write
+                    continue
+                self._exact[entry["key"]] = entry["response"]
+                self._namespaces.append(entry["namespace"])
+                self._prompts.append(entry["prompt"])
+                self._responses.append(entry["response"])
+
+
+class SemanticJudgeCache(SemanticCache):
+    """
+    SemanticCache of judge evaluations, keyed on the formatted transcript.
+
+    Simulations of the same scenario often produce near-identical
+    transcripts; those reuse a stored evaluation instead of calling the
+    judge again. Matches are only made between evaluations for the same
+    user goal. Evaluations are stored as JSON.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        threshold: float = 0.92,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2"
+    ):
+        super().__init__(path=path, threshold=threshold, model_name=model_name)
+
+    def get_evaluation(self, transcript: str, user_goal: str = None) -> Optional[Dict]:
+        """Return a cached evaluation for this transcript, or None on miss."""
+        cached = self.get((transcript, user_goal), transcript, namespace=user_goal or "")
+        if cached is None:
+            return None
+        return json.loads(cached)
+
+    async def get_evaluation_async(self, transcript: str, user_goal: str = None) -> Optional[Dict]:
+        """Async version of get_evaluation."""
+        cached = await self.get_async((transcript, user_goal), transcript, namespace=user_goal or "")
+        if cached is None:
+            return None
+        return json.loads(cached)
+
+    def put_evaluation(self, transcript: str, user_goal: str, evaluation: Dict):
+        """Store an evaluation for this transcript."""
+        self.put((transcript, user_goal), transcript, json.dumps(evaluation), namespace=user_goal or "")
+
+
+class RedisResponseCache:
+    """
+    Exact-match cache of Claude responses shared across processes via Redis.
+
+    Keys are a blake2b hash of the full request (model, system, messages,
+    max_tokens, ...), so only byte-identical requests hit. Values are the
+    serialized Message and expire after `ttl` seconds. Redis errors are
+    treated as cache misses.
+    """
+
+    def __init__(self, url: str, ttl: int = 3600):
+        import redis
+        import redis.asyncio
+
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+        self._async_client = redis.asyncio.Redis.from_url(url)
+
+    def get(self, request: Dict):
+        try:
+            raw = self._client.get(self._key(request))
+        except Exception:
+            return None
+        return self._decode(raw)
+
+    def set(self, request: Dict, response):
+        try:
+            self._client.setex(self._key(request), self.ttl, response.model_dump_json())
+        except Exception:
+            pass
+
+    async def get_async(self, request: Dict):
+        try:
+            raw = await self._async_client.get(self._key(request))
+        except Exception:
+            return None
+        return self._decode(raw)
+
+    async def set_async(self, request: Dict, response):
+        try:
+            await self._async_client.setex(self._key(request), self.ttl, response.model_dump_json())
+        except Exception:
+            pass
+
+    def _key(self, request: Dict) -> str:
+        digest = hashlib.blake2b(orjson.dumps(request, option=orjson.OPT_SORT_KEYS), digest_size=16)
+        return f"llm:{digest.hexdigest()}"
+
+    def _decode(self, raw):
+        if raw is None:
+            return None
+        return Message.model_validate_json(raw)
@@ -0,0 +1,389 @@
+"""
+Shared Anthropic client configuration for agents and the judge.
+"""
+
+import asyncio
+import contextlib
+import functools
+import os
+import time
+import types
+import weakref
+from typing import Dict, List
+
+import anthropic
+import httpx
+import orjson
+from anthropic import Anthropic, AsyncAnthropic
+
+from agents.cache import RedisResponseCache
+
+
+# Connection pool sized for concurrent batch simulations. HTTP/2 lets
+# concurrent requests multiplex over a few connections instead of paying a
+# TCP/TLS handshake each. The read timeout matches the SDK default (600s)
+# since non-streaming calls send nothing until generation finishes.
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=100)
+HTTP_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
+
+@functools.lru_cache(maxsize=None)
+def default_api_key() -> str:
+    """
+    ANTHROPIC_API_KEY from the environment, looked up once per process.
+
+    Resolved lazily (not at import) because the entry points call
+    load_dotenv() after importing the agents.
+    """
+    return os.getenv("ANTHROPIC_API_KEY")
+
+
+@functools.lru_cache(maxsize=None)
+def default_api_keys() -> tuple:
+    """
+    Comma-separated ANTHROPIC_API_KEYS from the environment, for spreading
+    batch traffic over several keys with AnthropicPool. Empty if unset.
+    """
+    return tuple(key.strip() for key in os.getenv("ANTHROPIC_API_KEYS", "").split(",") if key.strip())
+
+
+@functools.lru_cache(maxsize=None)
+def create_client(api_key: str = None) -> Anthropic:
+    """Sync Anthropic client on a tuned HTTP/2 pool, shared per API key."""
+    return Anthropic(
+        api_key=api_key or default_api_key(),
+        http_client=httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    )
+
+
+def create_async_client(api_key: str = None, max_retries: int = anthropic.DEFAULT_MAX_RETRIES) -> AsyncAnthropic:
+    """
+    Async Anthropic client on a tuned HTTP/2 pool.
+
+    Not shared process-wide: an httpx.AsyncClient's connections belong to the
+    event loop they were opened on. Use get_async_client to share one per loop.
+    """
+    return AsyncAnthropic(
+        api_key=api_key or default_api_key(),
+        max_retries=max_retries,
+        http_client=httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+    )
+
+
+# Async clients cached per event loop, then per (API key, max_retries)
+_loop_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[tuple, AsyncAnthropic]]" = weakref.WeakKeyDictionary()
+
+
+def get_async_client(api_key: str = None, max_retries: int = anthropic.DEFAULT_MAX_RETRIES) -> AsyncAnthropic:
+    """
+    Async client for the running event loop, shared per API key and retry
+    setting.
+
+    Every agent and conversation on a loop reuses one HTTP/2 connection pool,
+    and a new loop (e.g. a second asyncio.run) gets a fresh client instead of
+    connections left over from a closed loop.
+    """
+    clients = _loop_clients.setdefault(asyncio.get_running_loop(), {})
+    key = (api_key or default_api_key(), max_retries)
+    if key not in clients:
+        clients[key] = create_async_client(*key)
+    return clients[key]
+
+
+async def close_async_clients():
+    """Close the running event loop's shared async clients."""
+    clients = _loop_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+
+
+class SharedAsyncClient:
+    """
+    Stands in for an AsyncAnthropic client, forwarding to the running event
+    loop's shared client (see get_async_client). Safe to create outside any
+    event loop, e.g. in an agent's __init__.
+    """
+
+    def __init__(self, api_key: str = None, max_retries: int = anthropic.DEFAULT_MAX_RETRIES):
+        self.api_key = api_key
+        self.max_retries = max_retries
+
+    def __getattr__(self, name):
+        return getattr(get_async_client(self.api_key, self.max_retries), name)
+
+
+class TokenBucket:
+    """
+    Async token bucket: refills `rate` tokens per second up to `capacity`.
+
+    acquire(n) waits until n tokens are available and takes them; requests
+    larger than the capacity wait for a full bucket.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self, n: float = 1):
+        n = min(n, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self.tokens >= n:
+                self.tokens -= n
+                return
+            await asyncio.sleep((n - self.tokens) / self.rate)
+
+
+def estimate_input_tokens(request: Dict) -> int:
+    """Rough input token count for a request (~4 bytes of prompt JSON per token)."""
+    prompt = {key: request.get(key) for key in ("system", "messages", "tools")}
+    return len(orjson.dumps(prompt)) // 4
+
+
+def _retry_after(error: Exception) -> float:
+    """Seconds the API asked us to wait (retry-after header), or None."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return min(float(response.headers.get("retry-after")), 60.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AnthropicPool:
+    """
+    Async Anthropic clients for several API keys behind a single client-like
+    `messages.create` / `messages.stream` interface.
+
+    Each request goes to the key with the fewest requests in flight, with at
+    most `max_concurrency` in flight per key. Rate-limit, overload and
+    connection errors fail over to the other keys straight away (the SDK's
+    own same-key retries are off), and the failed key cools down - for its
+    retry-after if the API sent one, else an exponentially growing delay -
+    before it is picked again.
+
+    Optional per-key token buckets keep each key under its requests-per-minute
+    and input-tokens-per-minute limits, so requests wait client-side instead
+    of being rejected with rate-limit errors.
+    """
+
+    # Errors worth retrying on another key
+    RETRYABLE_ERRORS = (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError)
+
+    def __init__(
+        self,
+        api_keys: List[str],
+        max_concurrency: int = 20,
+        max_attempts: int = 4,
+        base_delay: float = 1.0,
+        requests_per_minute: int = None,
+        input_tokens_per_minute: int = None
+    ):
+        if not api_keys:
+            raise ValueError("AnthropicPool needs at least one API key")
+
+        self._clients = [SharedAsyncClient(api_key, max_retries=0) for api_key in api_keys]
+        self._slots = [asyncio.Semaphore(max_concurrency) for _ in api_keys]
+        self._request_buckets = [
+            TokenBucket(requests_per_minute / 60, requests_per_minute) if requests_per_minute else None
+            for _ in api_keys
+        ]
+        self._token_buckets = [
+            TokenBucket(input_tokens_per_minute / 60, input_tokens_per_minute) if input_tokens_per_minute else None
+            for _ in api_keys
+        ]
+        self._in_flight = [0] * len(api_keys)
+        # time.monotonic() before which a key that just failed isn't picked
+        self._cooldown_until = [0.0] * len(api_keys)
+        self._turn = 0
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.messages = types.SimpleNamespace(create=self._create, stream=self._stream)
+
+    @property
+    def beta(self):
+        """Beta APIs (e.g. Message Batches) of the first key."""
+        return self._clients[0].beta
+
+    def _pick(self, exclude=()) -> int:
+        """
+        Index of the least busy key not in exclude and not cooling down; ties
+        rotate between keys. If every candidate is cooling down, the one that
+        recovers first.
+        """
+        n = len(self._clients)
+        start = self._turn
+        self._turn = (start + 1) % n
+        candidates = [(start + k) % n for k in range(n) if (start + k) % n not in exclude]
+        now = time.monotonic()
+        ready = [i for i in candidates if self._cooldown_until[i] <= now]
+        if not ready:
+            return min(candidates, key=self._cooldown_until.__getitem__)
+        return min(ready, key=self._in_flight.__getitem__)
+
+    async def _wait_cooldown(self, i: int):
+        delay = self._cooldown_until[i] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _throttle(self, i: int, request: Dict):
+        """Wait for key i's rate limits to admit this request."""
+        if self._request_buckets[i]:
+            await self._request_buckets[i].acquire()
+        if self._token_buckets[i]:
+            await self._token_buckets[i].acquire(estimate_input_tokens(request))
+
+    def _fail_over(self, i: int, failed: set, delay: float, error: Exception) -> float:
+        """
+        Mark key i as failed for this request and put it on cooldown for the
+        error's retry-after, or `delay` without one. Once every key has
+        failed, a new round starts with the delay doubled. Returns the next
+        delay.
+        """
+        cooldown = _retry_after(error) or delay
+        self._cooldown_until[i] = max(self._cooldown_until[i], time.monotonic() + cooldown)
+        failed.add(i)
+        if len(failed) == len(self._clients):
+            failed.clear()
+            delay *= 2
+        return delay
+
+    async def _create(self, **kwargs):
+        failed = set()
+        delay = self.base_delay
+
+        for attempt in range(self.max_attempts):
+            i = self._pick(failed)
+            self._in_flight[i] += 1
+            try:
+                await self._wait_cooldown(i)
+                await self._throttle(i, kwargs)
+                async with self._slots[i]:
+                    return await self._clients[i].messages.create(**kwargs)
+            except self.RETRYABLE_ERRORS as e:
+                if attempt == self.max_attempts - 1:
+                    raise
+                error = e
+            finally:
+                self._in_flight[i] -= 1
+            delay = self._fail_over(i, failed, delay, error)
+
+    @contextlib.asynccontextmanager
+    async def _stream(self, **kwargs):
+        failed = set()
+        delay = self.base_delay
+
+        for attempt in range(self.max_attempts):
+            i = self._pick(failed)
+            self._in_flight[i] += 1
+            try:
+                async with contextlib.AsyncExitStack() as stack:
+                    await self._wait_cooldown(i)
+                    await self._throttle(i, kwargs)
+                    await stack.enter_async_context(self._slots[i])
+                    # Errors opening the stream (the request itself) fail
+                    # over like _create; errors once it has started don't
+                    try:
+                        stream = await stack.enter_async_context(self._clients[i].messages.stream(**kwargs))
+                    except self.RETRYABLE_ERRORS as e:
+                        if attempt == self.max_attempts - 1:
+                            raise
+                        error = e
+                        stream = None
+
+                    if stream is not None:
+                        yield stream
+                        return
+            finally:
+                self._in_flight[i] -= 1
+            delay = self._fail_over(i, failed, delay, error)
+
+
+def agent_async_client(api_key: str = None, pool: AnthropicPool = None):
+    """
+    Async client for an agent: the shared pool when given, so async (batch)
+    calls are spread over several API keys, else a SharedAsyncClient.
+    """
+    return pool if pool is not None else SharedAsyncClient(api_key)
+
+
+@functools.lru_cache(maxsize=None)
+def get_response_cache() -> RedisResponseCache:
+    """Redis response cache shared by all workers, or None if REDIS_URL is unset."""
+    url = os.getenv("REDIS_URL")
+    return RedisResponseCache(url) if url else None
+
+
+def create_message(client: Anthropic, request: Dict, use_cache: bool = True):
+    """
+    client.messages.create(**request), served from the Redis cache when possible.
+
+    use_cache=False always calls the API, for requests whose output should
+    vary between identical calls.
+    """
+    cache = get_response_cache() if use_cache else None
+    if cache:
+        cached = cache.get(request)
+        if cached is not None:
+            return cached
+
+    response = client.messages.create(**request)
+    if cache:
+        cache.set(request, response)
+    return response
+
+
+async def create_message_async(client: AsyncAnthropic, request: Dict, use_cache: bool = True):
+    """Async version of create_message."""
+    cache = get_response_cache() if use_cache else None
+    if cache:
+        cached = await cache.get_async(request)
+        if cached is not None:
+            return cached
+
+    response = await client.messages.create(**request)
+    if cache:
+        await cache.set_async(request, response)
+    return response
+
+
+def stream_message(client: Anthropic, request: Dict):
+    """
+    Like create_message, but receives the response over a stream.
+
+    Tokens arrive as they are generated instead of in one body at the end,
+    so long outputs never sit on an idle connection; returns the final
+    assembled Message.
+    """
+    cache = get_response_cache()
+    if cache:
+        cached = cache.get(request)
+        if cached is not None:
+            return cached
+
+    with client.messages.stream(**request) as stream:
+        response = stream.get_final_message()
+    if cache:
+        cache.set(request, response)
+    return response
+
+
+async def stream_message_async(client: AsyncAnthropic, request: Dict):
+    """Async version of stream_message."""
+    cache = get_response_cache()
+    if cache:
+        cached = await cache.get_async(request)
+        if cached is not None:
+            return cached
+
+    async with client.messages.stream(**request) as stream:
+        response = await stream.get_final_message()
+    if cache:
+        await cache.set_async(request, response)
+    return response
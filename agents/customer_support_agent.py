@@ -3,45 +3,118 @@ Simple Customer Support Agent for Beta/POC purposes.
 Naive implementation - just responds to basic customer queries.
 """
 
-from anthropic import Anthropic
-import os
-from typing import List, Dict
+import textwrap
+from typing import List, Dict, Iterator
+
+from agents.clients import AnthropicPool, agent_async_client, create_client, create_message, create_message_async
+
+
+# Static system prompt - dedented once at import and kept at module level so
+# the text is byte-identical across calls, which prompt caching requires.
+SYSTEM_PROMPT = textwrap.dedent("""
+    You are a customer support agent for an e-commerce company.
+    Your job is to help customers with their issues including:
+        - Order delays and tracking
+        - Refunds and returns
+        - Wrong items received
+        - Account issues
+        - Billing disputes
+        - Subscription cancellations
+
+    Be helpful and friendly. Keep responses concise.
+""").strip()
 
 
 class CustomerSupportAgent:
     """Simple, naive customer support agent."""
 
-    def __init__(self, api_key: str = None):
-        self.client = Anthropic(api_key=api_key or os.getenv("ANTHROPIC_API_KEY"))
+    def __init__(self, api_key: str = None, max_tokens: int = 256, pool: AnthropicPool = None):
+        self.client = create_client(api_key)
+        self.async_client = agent_async_client(api_key, pool)
         self.model = "claude-3-5-sonnet-20241022"
+        # Replies are meant to be concise, so cap generation at a few sentences;
+        # meta["hit_max_tokens"] flags any reply that ran into the cap
+        self.max_tokens = max_tokens
 
-    def respond(self, conversation_history: List[Dict], user_message: str, user_profile: Dict = None) -> Dict:
+    def respond(self, messages: List[Dict], user_profile: Dict = None) -> Dict:
         """
-        Generate a response to the user's message.
+        Generate a response to the user's latest message.
 
         Args:
-            conversation_history: Previous messages in the conversation
-            user_message: Current message from the user
+            messages: Conversation in Claude message format, ending with the
+                current user message (see build_messages). Not modified.
             user_profile: Optional user profile information
 
         Returns:
             Dict with response, actions, and metadata
         """
-        # Build system prompt - keep it simple and naive
-        system_prompt = """
-            You are a customer support agent for an e-commerce company.
-            Your job is to help customers with their issues including:
-                - Order delays and tracking
-                - Refunds and returns
-                - Wrong items received
-                - Account issues
-                - Billing disputes
-                - Subscription cancellations
-
-            Be helpful and friendly. Keep responses concise.
+        request = self._build_request(messages)
+
+        # Call Claude API
+        try:
+            response = create_message(self.client, request)
+
+            response_text = response.content[0].text
+
+            return {
+                "response": response_text,
+                "actions": [],  # Simple agent doesn't take actions
+                "meta": self._build_meta(response)
+            }
+        except Exception as e:
+            return {
+                "response": f"I apologize, but I'm experiencing technical difficulties. Error: {str(e)}",
+                "actions": [],
+                "meta": {"error": str(e)}
+            }
+
+    async def respond_async(self, messages: List[Dict], user_profile: Dict = None) -> Dict:
+        """Async version of respond for concurrent simulations."""
+        request = self._build_request(messages)
+
+        try:
+            response = await create_message_async(self.async_client, request)
+
+            return {
+                "response": response.content[0].text,
+                "actions": [],
+                "meta": self._build_meta(response)
+            }
+        except Exception as e:
+            return {
+                "response": f"I apologize, but I'm experiencing technical difficulties. Error: {str(e)}",
+                "actions": [],
+                "meta": {"error": str(e)}
+            }
+
+    def respond_stream(self, messages: List[Dict], user_profile: Dict = None) -> Iterator[Dict]:
+        """
+        Stream a response to the user's latest message as it is generated.
+
+        Args:
+            messages: Conversation in Claude message format, ending with the
+                current user message (see build_messages). Not modified.
+            user_profile: Optional user profile information
+
+        Yields:
+            {"text": ...} events for each generated chunk, followed by a final
+            {"meta": ...} event with usage (or error) information
         """
+        request = self._build_request(messages)
 
-        # Build message history for Claude
+        try:
+            with self.client.messages.stream(**request) as stream:
+                for text in stream.text_stream:
+                    yield {"text": text}
+
+                final_message = stream.get_final_message()
+
+            yield {"meta": self._build_meta(final_message)}
+        except Exception as e:
+            yield {"meta": {"error": str(e)}}
+
+    def build_messages(self, conversation_history: List[Dict], user_message: str) -> List[Dict]:
+        """Build the Claude message list from raw history plus the current user message."""
         messages = []
         for msg in conversation_history:
             if msg.get("role") in ["user", "assistant"]:
@@ -56,28 +129,49 @@ class CustomerSupportAgent:
             "content": user_message
         })
 
-        # Call Claude API
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=1024,
-                system=system_prompt,
-                messages=messages
-            )
+        return messages
 
-            response_text = response.content[0].text
+    def _build_request(self, messages: List[Dict]) -> Dict:
+        """Build the Claude request, with cache breakpoints on the system prompt and history."""
+        return {
+            "model": self.model,
+            "max_tokens": self.max_tokens,
+            "system": [{
+                "type": "text",
+                "text": SYSTEM_PROMPT,
+                "cache_control": {"type": "ephemeral"}
+            }],
+            "messages": self._with_history_breakpoint(messages)
+        }
 
-            return {
-                "response": response_text,
-                "actions": [],  # Simple agent doesn't take actions
-                "meta": {
-                    "model": self.model,
-                    "tokens_used": response.usage.input_tokens + response.usage.output_tokens
-                }
-            }
-        except Exception as e:
-            return {
-                "response": f"I apologize, but I'm experiencing technical difficulties. Error: {str(e)}",
-                "actions": [],
-                "meta": {"error": str(e)}
-            }
+    def _with_history_breakpoint(self, messages: List[Dict]) -> List[Dict]:
+        """
+        Second cache breakpoint on the history prefix so only the newest
+        user message is processed uncached on multi-turn calls.
+
+        Returns a new list; the caller's messages are left untouched.
+        """
+        if len(messages) < 2 or not isinstance(messages[-2]["content"], str) or not messages[-2]["content"]:
+            return messages
+
+        prefix_end = {
+            "role": messages[-2]["role"],
+            "content": [{
+                "type": "text",
+                "text": messages[-2]["content"],
+                "cache_control": {"type": "ephemeral"}
+            }]
+        }
+        return messages[:-2] + [prefix_end, messages[-1]]
+
+    def _build_meta(self, response) -> Dict:
+        """Build response metadata from a Claude message's usage stats."""
+        usage = response.usage
+        return {
+            "model": self.model,
+            "tokens_used": usage.input_tokens + usage.output_tokens,
+            "output_tokens": usage.output_tokens,
+            "hit_max_tokens": response.stop_reason == "max_tokens",
+            "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", 0) or 0,
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", 0) or 0
+        }
@@ -3,24 +3,74 @@ Simple User Agent simulator for Beta/POC purposes.
 Naive implementation - simulates customers with different personalities and goals.
 """
 
-from anthropic import Anthropic
-import os
+import asyncio
+import re
+import textwrap
 from typing import List, Dict
 
+from agents.cache import SemanticCache
+from agents.clients import AnthropicPool, agent_async_client, create_client, create_message, create_message_async
+
+
+# Static instructions go first (and carry the cache breakpoint) so every
+# personality/scenario combination shares the same cacheable prefix; the
+# per-simulation details follow in a separate, uncached block.
+_STATIC_USER_SIM_PREAMBLE = textwrap.dedent("""
+    You are simulating a customer in a support conversation.
+
+    Respond naturally as this person would. Keep messages short (1-3 sentences) like a real chat.
+    If your goal has been met, say exactly "GOAL_MET" at the end of your message.
+    If you're frustrated and want to give up, say exactly "GIVING_UP" at the end.
+""").strip()
+
+# Sentinels the simulated user appends to signal the end of the conversation
+_SENTINEL_RE = re.compile(r"GOAL_MET|GIVING_UP")
+
+# Agent replies that hand over an explicit confirmation/reference code with
+# both letters and digits (e.g. "your refund confirmation number is
+# RF-20391"). With detect_resolution on, these end the conversation as
+# resolved without an LLM call. Off by default: the support agent has no
+# tools, so such codes are made up, and the persona would be ignored.
+_RESOLUTION_RE = re.compile(
+    r"(?i:\b(?:confirmation|reference)\s*(?:number|no\.?|#|id|code)?)"
+    r"\s*(?:is|:)?\s*#?(?=[A-Z0-9-]*\d)(?=[0-9-]*[A-Z])[A-Z0-9][A-Z0-9-]{4,}\b"
+)
+_RESOLVED_MESSAGE = "Great, thank you. That resolves my issue."
+
+_STATIC_OPENING_PREAMBLE = textwrap.dedent("""
+    Generate a customer's opening message for a support chat.
+
+    Generate a realistic opening message (1-2 sentences). Do not include any labels or meta-commentary.
+""").strip()
+
 
 class UserAgent:
     """Simple, naive user agent that simulates a customer."""
 
-    def __init__(self, api_key: str = None):
-        self.client = Anthropic(api_key=api_key or os.getenv("ANTHROPIC_API_KEY"))
+    def __init__(
+        self,
+        api_key: str = None,
+        cache: SemanticCache = None,
+        pool: AnthropicPool = None,
+        detect_resolution: bool = False
+    ):
+        self.client = create_client(api_key)
+        self.async_client = agent_async_client(api_key, pool)
         self.model = "claude-3-5-haiku-20241022"  # Use faster model for simulation
+        # Opt-in: a cached opening message is reused by every simulation of
+        # the same scenario and persona, which narrows batch diversity
+        self.opening_cache = cache
+        # Opt-in shortcut: accept any reply carrying a confirmation/reference
+        # code as resolving the issue (see _RESOLUTION_RE)
+        self.detect_resolution = detect_resolution
 
     def generate_response(
         self,
         personality: Dict,
         goal: str,
-        conversation_history: List[Dict],
-        agent_response: str
+        messages: List[Dict],
+        agent_response: str,
+        persona_prompt: str = None
     ) -> Dict:
         """
         Generate the user's next message based on personality and goal.
@@ -28,80 +78,48 @@ class UserAgent:
         Args:
             personality: User personality traits (tone, technical_literacy, formality, etc.)
             goal: What the user is trying to accomplish
-            conversation_history: Previous messages
+            messages: Previous messages, already in Claude message format. Not modified.
             agent_response: Latest response from customer support agent
+            persona_prompt: Precomputed build_persona_prompt(personality, goal),
+                reused across the turns of a conversation (optional)
 
         Returns:
             Dict with user's message and whether goal is met
         """
-        # Build system prompt based on personality
-        tone = personality.get("tone", "neutral")
-        tech_literacy = personality.get("technical_literacy", "intermediate")
-        formality = personality.get("formality", "neutral")
-        trust_level = personality.get("trust_level", "cautious")
-
-        system_prompt = f"""You are simulating a customer in a support conversation.
+        if self.detect_resolution and _RESOLUTION_RE.search(agent_response):
+            return self._resolved_response()
 
-            Your personality:
-                - Tone: {tone}
-                - Technical literacy: {tech_literacy}
-                - Formality: {formality}
-                - Trust level: {trust_level}
+        if persona_prompt is None:
+            persona_prompt = self.build_persona_prompt(personality, goal)
+        request = self._build_response_request(persona_prompt, messages, agent_response)
 
-            Your goal: {goal}
+        try:
+            response = create_message(self.client, request)
+            return self._parse_response(response)
+        except Exception as e:
+            return self._fallback_response(e)
 
-            Respond naturally as this person would. Keep messages short (1-3 sentences) like a real chat.
-            If your goal has been met, say exactly "GOAL_MET" at the end of your message.
-            If you're frustrated and want to give up, say exactly "GIVING_UP" at the end.
-        """
+    async def generate_response_async(
+        self,
+        personality: Dict,
+        goal: str,
+        messages: List[Dict],
+        agent_response: str,
+        persona_prompt: str = None
+    ) -> Dict:
+        """Async version of generate_response for concurrent simulations."""
+        if self.detect_resolution and _RESOLUTION_RE.search(agent_response):
+            return self._resolved_response()
 
-        # Build message history
-        messages = []
-        for msg in conversation_history:
-            if msg.get("role") in ["user", "assistant"]:
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
-
-        # Add the agent's latest response
-        messages.append({
-            "role": "user",
-            "content": f"The customer support agent just said: {agent_response}\n\nHow do you respond?"
-        })
+        if persona_prompt is None:
+            persona_prompt = self.build_persona_prompt(personality, goal)
+        request = self._build_response_request(persona_prompt, messages, agent_response)
 
         try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=256,
-                system=system_prompt,
-                messages=messages
-            )
-
-            user_message = response.content[0].text
-
-            # Check if goal is met or user is giving up
-            goal_met = "GOAL_MET" in user_message
-            giving_up = "GIVING_UP" in user_message
-
-            # Clean up the message
-            user_message = user_message.replace("GOAL_MET", "").replace("GIVING_UP", "").strip()
-
-            return {
-                "message": user_message,
-                "goal_met": goal_met,
-                "giving_up": giving_up,
-                "meta": {
-                    "tokens_used": response.usage.input_tokens + response.usage.output_tokens
-                }
-            }
+            response = await create_message_async(self.async_client, request)
+            return self._parse_response(response)
         except Exception as e:
-            return {
-                "message": "I need help with my issue.",
-                "goal_met": False,
-                "giving_up": False,
-                "meta": {"error": str(e)}
-            }
+            return self._fallback_response(e)
 
     def generate_initial_message(self, personality: Dict, scenario: Dict) -> str:
         """
@@ -114,30 +132,257 @@ class UserAgent:
         Returns:
             Initial message string
         """
+        cache_key = self._opening_cache_key(personality, scenario)
+        if self.opening_cache is not None:
+            cached = self.opening_cache.get(*cache_key)
+            if cached is not None:
+                return cached
+
+        request = self._build_initial_request(personality, scenario)
+
+        try:
+            response = create_message(self.client, request, use_cache=self.opening_cache is not None)
+            return self._store_opening(cache_key, response.content[0].text.strip())
+        except Exception:
+            return self._fallback_opening(scenario)
+
+    async def generate_initial_message_async(self, personality: Dict, scenario: Dict) -> str:
+        """Async version of generate_initial_message for concurrent simulations."""
+        cache_key = self._opening_cache_key(personality, scenario)
+        if self.opening_cache is not None:
+            cached = await self.opening_cache.get_async(*cache_key)
+            if cached is not None:
+                return cached
+
+        request = self._build_initial_request(personality, scenario)
+
+        try:
+            response = await create_message_async(self.async_client, request, use_cache=self.opening_cache is not None)
+            return self._store_opening(cache_key, response.content[0].text.strip())
+        except Exception:
+            return self._fallback_opening(scenario)
+
+    async def generate_initial_messages_batch(
+        self,
+        pairs: List[tuple],
+        poll_interval: float = 5.0
+    ) -> List[str]:
+        """
+        Generate opening messages for many (personality, scenario) pairs at once.
+
+        Uncached prompts are submitted together through the Message Batches API,
+        so a whole batch of simulations costs one request against the RPM limit
+        instead of one per simulation. Batches can take minutes to process, so
+        this is meant for large non-interactive runs.
+
+        Args:
+            pairs: List of (personality, scenario) tuples
+            poll_interval: Seconds between batch status checks
+
+        Returns:
+            Opening messages, in the same order as pairs
+        """
+        messages = [None] * len(pairs)
+        pending = {}  # custom_id -> (cache key info, indexes into pairs, request)
+        custom_ids = {}  # cache key -> custom_id, so identical prompts are requested once
+
+        for i, (personality, scenario) in enumerate(pairs):
+            cache_key = self._opening_cache_key(personality, scenario)
+            if self.opening_cache is not None:
+                cached = await self.opening_cache.get_async(*cache_key)
+                if cached is not None:
+                    messages[i] = cached
+                    continue
+                key = cache_key[0]
+            else:
+                # Without a cache every simulation gets its own opening message
+                key = i
+
+            if key not in custom_ids:
+                custom_ids[key] = f"opening-{len(custom_ids)}"
+                pending[custom_ids[key]] = (cache_key, [], self._build_initial_request(personality, scenario))
+            pending[custom_ids[key]][1].append(i)
+
+        if pending:
+            try:
+                batch = await self.async_client.beta.messages.batches.create(
+                    requests=[
+                        {"custom_id": custom_id, "params": request}
+                        for custom_id, (_, _, request) in pending.items()
+                    ]
+                )
+
+                while batch.processing_status != "ended":
+                    await asyncio.sleep(poll_interval)
+                    batch = await self.async_client.beta.messages.batches.retrieve(batch.id)
+
+                async for entry in await self.async_client.beta.messages.batches.results(batch.id):
+                    if entry.result.type != "succeeded" or entry.custom_id not in pending:
+                        continue
+                    cache_key, indexes, _ = pending[entry.custom_id]
+                    message = self._store_opening(cache_key, entry.result.message.content[0].text.strip())
+                    for i in indexes:
+                        messages[i] = message
+            except Exception as e:
+                print(f"Opening message batch failed: {str(e)}")
+
+        # Fallback to simple template for anything the batch did not return
+        for i, (personality, scenario) in enumerate(pairs):
+            if messages[i] is None:
+                messages[i] = self._fallback_opening(scenario)
+
+        return messages
+
+    def build_persona_prompt(self, personality: Dict, goal: str) -> str:
+        """
+        Per-simulation system prompt block (personality and goal).
+
+        Fixed for a whole conversation, so callers build it once and pass it
+        to generate_response on every turn.
+        """
+        tone = personality.get("tone", "neutral")
+        tech_literacy = personality.get("technical_literacy", "intermediate")
+        formality = personality.get("formality", "neutral")
+        trust_level = personality.get("trust_level", "cautious")
+
+        return (
+            "Your personality:\n"
+            f"- Tone: {tone}\n"
+            f"- Technical literacy: {tech_literacy}\n"
+            f"- Formality: {formality}\n"
+            f"- Trust level: {trust_level}\n"
+            "\n"
+            f"Your goal: {goal}"
+        )
+
+    def _build_response_request(self, persona_prompt: str, messages: List[Dict], agent_response: str) -> Dict:
+        """Build the Claude request for the user's next message."""
+        # Second cache breakpoint on the history prefix so only the newest
+        # prompt is processed uncached as the conversation grows. The caller's
+        # list is shared across turns, so build a new one rather than mutate it.
+        history = list(messages)
+        if history and isinstance(history[-1]["content"], str) and history[-1]["content"]:
+            history[-1] = {
+                "role": history[-1]["role"],
+                "content": [{
+                    "type": "text",
+                    "text": history[-1]["content"],
+                    "cache_control": {"type": "ephemeral"}
+                }]
+            }
+
+        # Add the agent's latest response
+        history.append({
+            "role": "user",
+            "content": f"The customer support agent just said: {agent_response}\n\nHow do you respond?"
+        })
+
+        return {
+            "model": self.model,
+            "max_tokens": 256,
+            "system": [
+                {
+                    "type": "text",
+                    "text": _STATIC_USER_SIM_PREAMBLE,
+                    "cache_control": {"type": "ephemeral"}
+                },
+                {"type": "text", "text": persona_prompt}
+            ],
+            "messages": history
+        }
+
+    def _build_initial_request(self, personality: Dict, scenario: Dict) -> Dict:
+        """Build the Claude request for the user's opening message."""
         tone = personality.get("tone", "neutral")
         formality = personality.get("formality", "neutral")
         scenario_type = scenario.get("type", "general")
         context = scenario.get("context", "")
 
-        system_prompt = f"""Generate a customer's opening message for a support chat.
+        scenario_prompt = (
+            f"Scenario: {scenario_type}\n"
+            f"Context: {context}\n"
+            f"Tone: {tone}\n"
+            f"Formality: {formality}"
+        )
 
-            Scenario: {scenario_type}
-            Context: {context}
-            Tone: {tone}
-            Formality: {formality}
+        return {
+            "model": self.model,
+            "max_tokens": 128,
+            "system": [
+                {
+                    "type": "text",
+                    "text": _STATIC_OPENING_PREAMBLE,
+                    "cache_control": {"type": "ephemeral"}
+                },
+                {"type": "text", "text": scenario_prompt}
+            ],
+            "messages": [{"role": "user", "content": "Generate the message:"}]
+        }
 
-            Generate a realistic opening message (1-2 sentences). Do not include any labels or meta-commentary.
+    def _opening_cache_key(self, personality: Dict, scenario: Dict) -> tuple:
         """
+        Cache key for an opening message.
 
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=128,
-                system=system_prompt,
-                messages=[{"role": "user", "content": "Generate the message:"}]
-            )
-
-            return response.content[0].text.strip()
-        except Exception as e:
-            # Fallback to simple template
-            return f"Hi, I need help with {scenario_type}."
+        Returns (exact key, text to embed, namespace): near-duplicate scenario
+        contexts only match within the same scenario type, tone and formality.
+        """
+        tone = personality.get("tone", "neutral")
+        formality = personality.get("formality", "neutral")
+        scenario_type = scenario.get("type", "general")
+        context = scenario.get("context", "")
+
+        key = (scenario_type, context, tone, formality)
+        namespace = f"{scenario_type}|{tone}|{formality}"
+        return key, context, namespace
+
+    def _store_opening(self, cache_key: tuple, message: str) -> str:
+        """Cache a generated opening message, if caching is on, and return it."""
+        if self.opening_cache is not None:
+            key, context, namespace = cache_key
+            self.opening_cache.put(key, context, message, namespace)
+        return message
+
+    def _fallback_opening(self, scenario: Dict) -> str:
+        """Simple template opening used when generation fails."""
+        return f"Hi, I need help with {scenario.get('type', 'general')}."
+
+    def _parse_response(self, response) -> Dict:
+        """Extract the user's message and goal/give-up signals from a Claude response."""
+        user_message = response.content[0].text
+
+        # Check if goal is met or user is giving up
+        found = set(_SENTINEL_RE.findall(user_message))
+        goal_met = "GOAL_MET" in found
+        giving_up = "GIVING_UP" in found
+
+        # Clean up the message
+        user_message = _SENTINEL_RE.sub("", user_message).strip()
+
+        return {
+            "message": user_message,
+            "goal_met": goal_met,
+            "giving_up": giving_up,
+            "meta": {
+                "tokens_used": response.usage.input_tokens + response.usage.output_tokens,
+                "cache_creation_input_tokens": getattr(response.usage, "cache_creation_input_tokens", 0) or 0,
+                "cache_read_input_tokens": getattr(response.usage, "cache_read_input_tokens", 0) or 0
+            }
+        }
+
+    def _resolved_response(self) -> Dict:
+        """Closing user message when the agent's reply deterministically resolves the issue."""
+        return {
+            "message": _RESOLVED_MESSAGE,
+            "goal_met": True,
+            "giving_up": False,
+            "meta": {"tokens_used": 0, "short_circuit": "resolution_detected"}
+        }
+
+    def _fallback_response(self, error: Exception) -> Dict:
+        """Neutral user message used when the Claude call fails."""
+        return {
+            "message": "I need help with my issue.",
+            "goal_met": False,
+            "giving_up": False,
+            "meta": {"error": str(error)}
+        }
@@ -3,15 +3,16 @@ AI Customer Support Evaluation Platform
 FastAPI application for running evaluations and simulations.
 """
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from typing import List, Dict, Optional
+from contextlib import asynccontextmanager
 import os
+import msgspec
+import orjson
 from dotenv import load_dotenv
 
-from agents.customer_support_agent import CustomerSupportAgent
-from agents.user_agent import UserAgent
-from evaluators.judge import LLMJudge
+from agents.clients import close_async_clients
 from orchestrator.simulator import EvaluationOrchestrator
 from orchestrator.reporter import EvaluationReporter
 from config.scenarios import SCENARIOS, PERSONALITIES, get_scenario, get_personality
@@ -19,41 +20,78 @@ from config.scenarios import SCENARIOS, PERSONALITIES, get_scenario, get_persona
 # Load environment variables
 load_dotenv()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Agents share one async Anthropic client per event loop; close the
+    # server loop's clients (and their keep-alive connections) on shutdown
+    await close_async_clients()
+
+
 app = FastAPI(
     title="AI Customer Support Evaluation Platform",
     description="Platform for evaluating AI customer support agents with red team simulations",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Initialize components
 orchestrator = EvaluationOrchestrator()
-reporter = EvaluationReporter()
+
+# Reuse the orchestrator's agents across requests so their HTTP connection
+# pools (and keep-alive connections) survive between calls
+support_agent = orchestrator.support_agent
+judge = orchestrator.judge
+
+# Static responses serialized once at startup
+_SCENARIOS_BODY = orjson.dumps({"count": len(SCENARIOS), "scenarios": SCENARIOS})
+_PERSONALITIES_BODY = orjson.dumps({"count": len(PERSONALITIES), "personalities": PERSONALITIES})
+_HEALTH_BODY = orjson.dumps({"status": "healthy", "api_key_configured": bool(os.getenv("ANTHROPIC_API_KEY"))})
 
 
 # API Models
-class RespondRequest(BaseModel):
+# msgspec structs decoded straight from the request body (see _body), which is
+# much cheaper than Pydantic validation on the hot /respond and /evaluate paths
+class RespondRequest(msgspec.Struct):
     conversation_history: List[Dict]
     user_message: str
     user_profile: Optional[Dict] = None
 
 
-class SingleSimulationRequest(BaseModel):
+class SingleSimulationRequest(msgspec.Struct):
     scenario_id: str
     personality_id: str
     max_turns: Optional[int] = 10
 
 
-class BatchSimulationRequest(BaseModel):
+class BatchSimulationRequest(msgspec.Struct):
     num_simulations: int = 100
     scenario_ids: Optional[List[str]] = None
     personality_ids: Optional[List[str]] = None
+    batch_openings: bool = False
+    batch_judging: bool = False
 
 
-class EvaluateRequest(BaseModel):
+class EvaluateRequest(msgspec.Struct):
     conversation_history: List[Dict]
     user_goal: Optional[str] = None
 
 
+def _body(model):
+    """FastAPI dependency decoding the JSON request body into a msgspec struct."""
+    decoder = msgspec.json.Decoder(model)
+
+    async def parse(request: Request):
+        try:
+            return decoder.decode(await request.body())
+        except msgspec.DecodeError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+    return parse
+
+
 # Endpoints
 @app.get("/")
 def root():
@@ -67,7 +105,8 @@ def root():
             "simulate": "/simulate",
             "batch_simulate": "/batch_simulate",
             "evaluate": "/evaluate",
-            "respond": "/respond"
+            "respond": "/respond",
+            "respond_sync": "/respond_sync"
         }
     }
 
@@ -75,45 +114,54 @@ def root():
 @app.get("/scenarios")
 def list_scenarios():
     """Get list of available scenarios."""
-    return {
-        "count": len(SCENARIOS),
-        "scenarios": SCENARIOS
-    }
+    return Response(content=_SCENARIOS_BODY, media_type="application/json")
 
 
 @app.get("/personalities")
 def list_personalities():
     """Get list of available personality profiles."""
-    return {
-        "count": len(PERSONALITIES),
-        "personalities": PERSONALITIES
-    }
+    return Response(content=_PERSONALITIES_BODY, media_type="application/json")
 
 
 @app.post("/respond")
-def respond(request: RespondRequest):
+def respond(request: RespondRequest = Depends(_body(RespondRequest))):
     """
     Customer support agent responds to user message.
+    Streams the response as Server-Sent Events.
     """
+    # Malformed history must fail before the 200 status line is sent
     try:
-        support_agent = CustomerSupportAgent()
-        response = support_agent.respond(
-            conversation_history=request.conversation_history,
-            user_message=request.user_message,
-            user_profile=request.user_profile
-        )
+        messages = support_agent.build_messages(request.conversation_history, request.user_message)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    def event_stream():
+        for event in support_agent.respond_stream(messages=messages, user_profile=request.user_profile):
+            yield b"data: " + orjson.dumps(event) + b"\n\n"
+        yield b"data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.post("/respond_sync")
+def respond_sync(request: RespondRequest = Depends(_body(RespondRequest))):
+    """
+    Customer support agent responds to user message (non-streaming).
+    """
+    try:
+        messages = support_agent.build_messages(request.conversation_history, request.user_message)
+        response = support_agent.respond(messages=messages, user_profile=request.user_profile)
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/evaluate")
-def evaluate(request: EvaluateRequest):
+def evaluate(request: EvaluateRequest = Depends(_body(EvaluateRequest))):
     """
     Evaluate a conversation using the LLM Judge.
     """
     try:
-        judge = LLMJudge()
         evaluation = judge.evaluate_conversation(
             conversation_history=request.conversation_history,
             user_goal=request.user_goal
@@ -124,7 +172,7 @@ def evaluate(request: EvaluateRequest):
 
 
 @app.post("/simulate")
-def simulate_single(request: SingleSimulationRequest):
+def simulate_single(request: SingleSimulationRequest = Depends(_body(SingleSimulationRequest))):
     """
     Run a single simulation with specified scenario and personality.
     """
@@ -151,7 +199,7 @@ def simulate_single(request: SingleSimulationRequest):
 
 
 @app.post("/batch_simulate")
-def simulate_batch(request: BatchSimulationRequest):
+async def simulate_batch(request: BatchSimulationRequest = Depends(_body(BatchSimulationRequest))):
     """
     Run batch simulations and return aggregated results.
     """
@@ -159,22 +207,32 @@ def simulate_batch(request: BatchSimulationRequest):
         # Filter scenarios and personalities if specified
         scenarios = SCENARIOS
         if request.scenario_ids:
-            scenarios = [s for s in SCENARIOS if s["id"] in request.scenario_ids]
+            scenario_ids = set(request.scenario_ids)
+            scenarios = [s for s in SCENARIOS if s["id"] in scenario_ids]
 
         personalities = PERSONALITIES
         if request.personality_ids:
-            personalities = [p for p in PERSONALITIES if p["id"] in request.personality_ids]
+            personality_ids = set(request.personality_ids)
+            personalities = [p for p in PERSONALITIES if p["id"] in personality_ids]
+
+        # Fold finished simulations into running totals while the rest of
+        # the batch is still waiting on the API. A reporter per request keeps
+        # concurrent batches' totals apart.
+        batch_reporter = EvaluationReporter()
 
         # Run simulations
-        results = orchestrator.run_batch_simulations(
+        results = await orchestrator.run_batch_simulations(
             num_simulations=request.num_simulations,
             scenarios=scenarios,
-            personalities=personalities
+            personalities=personalities,
+            batch_openings=request.batch_openings,
+            batch_judging=request.batch_judging,
+            on_result=batch_reporter.update_incremental
         )
 
         # Generate aggregated report
-        aggregated = reporter.aggregate_results(results)
-        report = reporter.generate_report(results)
+        aggregated = batch_reporter.aggregate_state()
+        report = batch_reporter.generate_report(results, aggregated=aggregated)
 
         return {
             "results": results,
@@ -188,7 +246,7 @@ def simulate_batch(request: BatchSimulationRequest):
 @app.get("/health")
 def health_check():
     """Health check endpoint."""
-    return {"status": "healthy", "api_key_configured": bool(os.getenv("ANTHROPIC_API_KEY"))}
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 
 if __name__ == "__main__":
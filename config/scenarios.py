@@ -2,6 +2,10 @@
 Scenario templates and personality profiles for simulations.
 """
 
+import os
+import random
+
+
 # Base scenario templates
 SCENARIOS = [
     {
@@ -247,29 +251,49 @@ PERTURBATIONS = [
 ]
 
 
+# ID indexes built once at import for O(1) lookups
+_SCENARIO_BY_ID = {scenario["id"]: scenario for scenario in SCENARIOS}
+_PERSONALITY_BY_ID = {personality["id"]: personality for personality in PERSONALITIES}
+
+
+# Listings printed by the CLI's list-scenarios / list-personalities, built
+# once at import
+SCENARIOS_LIST_TEXT = f"\nAvailable Scenarios ({len(SCENARIOS)}):\n\n" + "".join(
+    f"  {scenario['id']}: {scenario['type']}\n"
+    f"    Goal: {scenario['goal']}\n\n"
+    for scenario in SCENARIOS
+)
+PERSONALITIES_LIST_TEXT = f"\nAvailable Personalities ({len(PERSONALITIES)}):\n\n" + "".join(
+    f"  {personality['id']}:\n"
+    f"    Tone: {personality['tone']}, Tech: {personality['technical_literacy']}\n"
+    f"    Formality: {personality['formality']}, Trust: {personality['trust_level']}\n\n"
+    for personality in PERSONALITIES
+)
+
+
 def get_scenario(scenario_id: str):
     """Get scenario by ID."""
-    for scenario in SCENARIOS:
-        if scenario["id"] == scenario_id:
-            return scenario
-    return None
+    return _SCENARIO_BY_ID.get(scenario_id)
 
 
 def get_personality(personality_id: str):
     """Get personality by ID."""
-    for personality in PERSONALITIES:
-        if personality["id"] == personality_id:
-            return personality
-    return None
+    return _PERSONALITY_BY_ID.get(personality_id)
+
+
+# Dedicated generator rather than the shared module-level one. Reseeded in
+# forked children (as the random module does for its own instance) so worker
+# processes don't draw the same sequence.
+_rng = random.Random()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_rng.seed)
 
 
 def get_random_scenario():
     """Get a random scenario."""
-    import random
-    return random.choice(SCENARIOS)
+    return _rng.choice(SCENARIOS)
 
 
 def get_random_personality():
     """Get a random personality."""
-    import random
-    return random.choice(PERSONALITIES)
+    return _rng.choice(PERSONALITIES)
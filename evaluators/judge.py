@@ -3,33 +3,142 @@ LLM Judge for evaluating customer support conversations.
 Implements the 12-category failure ontology.
 """
 
-from anthropic import Anthropic
-import os
-import json
-from typing import List, Dict
+import asyncio
+import hashlib
+import textwrap
+from collections import OrderedDict
+from typing import Awaitable, List, Dict, Tuple
+
+from agents.cache import SemanticJudgeCache
+from agents.clients import AnthropicPool, agent_async_client, create_client, stream_message, stream_message_async
+
+
+# Static rubric - identical for every evaluation, so it goes first in the
+# prompt and carries the cache breakpoint; only the goal and transcript
+# that follow it are processed uncached.
+RUBRIC_STATIC = textwrap.dedent("""
+    You are an expert evaluator assessing the performance of an AI Customer Support Agent.
+
+    Given the conversation transcript below, evaluate the interaction across the following 12 categories of failure.
+    For each category, assign:
+    - A **score from 0-5** (0 = perfect, 5 = critical failure)
+    - A **short justification** (1-2 sentences)
+    - A **confidence level** (0-1)
+
+    Categories:
+    1. technical_failures: Downtime, latency, API issues, data quality
+    2. comprehension_failures: Intent misclassification, entity extraction, context loss
+    3. response_quality_failures: Hallucinations, irrelevant responses, contradictions
+    4. knowledge_failures: Knowledge gaps, outdated info, retrieval failures
+    5. task_execution_failures: Action failures, workflow errors, authorization issues
+    6. interaction_design_failures: Inappropriate tone, cultural insensitivity
+    7. safety_compliance_failures: Privacy breaches, security vulnerabilities
+    8. escalation_boundary_failures: Over-confidence, premature escalation
+    9. user_experience_failures: Frustration amplification, expectation mismatch
+    10. business_logic_failures: Policy misapplication, exception handling errors
+    11. meta_cognitive_failures: Calibration errors, self-awareness gaps
+    12. temporal_failures: State management, timing errors, sequencing failures
+
+    Then, provide:
+    1. overall_summary: Brief summary of the conversation quality
+    2. primary_failure_mode: The single most significant failure (if any)
+    3. suggestion: One actionable improvement recommendation
+
+    Record your evaluation by calling the emit_evaluation tool.
+""").strip()
+
+# The 12-category failure ontology, shared with the reporter
+FAILURE_CATEGORIES = (
+    "technical_failures",
+    "comprehension_failures",
+    "response_quality_failures",
+    "knowledge_failures",
+    "task_execution_failures",
+    "interaction_design_failures",
+    "safety_compliance_failures",
+    "escalation_boundary_failures",
+    "user_experience_failures",
+    "business_logic_failures",
+    "meta_cognitive_failures",
+    "temporal_failures"
+)
+
+# Output budgets for a verdict (~800 tokens as a tool call), widened in turn
+# whenever a verdict is cut off at max_tokens
+_MAX_TOKENS_STEPS = (768, 1536, 3072)
+
+# Transcript speaker labels; other roles are left out of the transcript
+_ROLE_MAP = {"user": "USER", "assistant": "AGENT"}
+
+# Per-conversation part of the prompt, sent after the cached rubric
+_JUDGE_PROMPT = "{goal_section}[Transcript begins below]\n\n{transcript}"
+
+# Per-category verdict in the emit_evaluation tool schema
+_CATEGORY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "integer", "minimum": 0, "maximum": 5},
+        "justification": {"type": "string"},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1}
+    },
+    "required": ["score", "justification", "confidence"]
+}
+
+# Forced tool call, so the verdict comes back as already-parsed JSON
+EVAL_TOOL = {
+    "name": "emit_evaluation",
+    "description": "Record the evaluation of the customer support conversation.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            **{category: _CATEGORY_SCHEMA for category in FAILURE_CATEGORIES},
+            "overall_summary": {"type": "string"},
+            "primary_failure_mode": {"type": "string"},
+            "suggestion": {"type": "string"}
+        },
+        "required": [*FAILURE_CATEGORIES, "overall_summary", "primary_failure_mode", "suggestion"]
+    }
+}
+
+# Several conversations judged in one call, one verdict per conversation
+BATCH_EVAL_TOOL = {
+    "name": "emit_evaluations",
+    "description": "Record the evaluations of the customer support conversations, in the order given.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "evaluations": {"type": "array", "items": EVAL_TOOL["input_schema"]}
+        },
+        "required": ["evaluations"]
+    }
+}
+
+# Largest max_tokens the judge model accepts
+_MAX_OUTPUT_TOKENS = 8192
 
 
 class LLMJudge:
     """Evaluates customer support conversations using structured failure taxonomy."""
 
-    FAILURE_CATEGORIES = [
-        "technical_failures",
-        "comprehension_failures",
-        "response_quality_failures",
-        "knowledge_failures",
-        "task_execution_failures",
-        "interaction_design_failures",
-        "safety_compliance_failures",
-        "escalation_boundary_failures",
-        "user_experience_failures",
-        "business_logic_failures",
-        "meta_cognitive_failures",
-        "temporal_failures"
-    ]
-
-    def __init__(self, api_key: str = None):
-        self.client = Anthropic(api_key=api_key or os.getenv("ANTHROPIC_API_KEY"))
+    FAILURE_CATEGORIES = FAILURE_CATEGORIES
+
+    def __init__(
+        self,
+        api_key: str = None,
+        cache: SemanticJudgeCache = None,
+        pool: AnthropicPool = None,
+        exact_cache_size: int = 1024
+    ):
+        self.client = create_client(api_key)
+        self.async_client = agent_async_client(api_key, pool)
         self.model = "claude-3-5-sonnet-20241022"
+        # Evaluations of byte-identical transcripts (e.g. deterministic
+        # replays), keyed by sha256 of transcript + goal. LRU-bounded: the
+        # app's judge lives as long as the server process.
+        self._exact_cache: "OrderedDict[str, Dict]" = OrderedDict()
+        self.exact_cache_size = exact_cache_size
+        # Optional cache of evaluations for (near-)duplicate transcripts
+        self.cache = cache
 
     def evaluate_conversation(self, conversation_history: List[Dict], user_goal: str = None) -> Dict:
         """
@@ -45,122 +154,314 @@ class LLMJudge:
         # Format conversation for the judge
         transcript = self._format_transcript(conversation_history)
 
-        # Build evaluation prompt
+        cached = self._cached_evaluation(transcript, user_goal)
+        if cached is not None:
+            return cached
+
         prompt = self._build_judge_prompt(transcript, user_goal)
 
         try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=4096,
-                system="You are an expert evaluator assessing AI customer support agent performance.",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            )
-
-            # Parse the JSON response
-            result_text = response.content[0].text
-
-            # Extract JSON from the response
-            # Try to find JSON in code blocks first
-            if "```json" in result_text:
-                json_start = result_text.find("```json") + 7
-                json_end = result_text.find("```", json_start)
-                result_text = result_text[json_start:json_end].strip()
-            elif "```" in result_text:
-                json_start = result_text.find("```") + 3
-                json_end = result_text.find("```", json_start)
-                result_text = result_text[json_start:json_end].strip()
-
-            evaluation = json.loads(result_text)
-
-            # Add metadata
-            evaluation["meta"] = {
-                "model": self.model,
-                "tokens_used": response.usage.input_tokens + response.usage.output_tokens
-            }
-
-            return evaluation
+            response = self._request_evaluation(prompt)
+            evaluation = self._parse_evaluation(response)
+        except Exception as e:
+            return self._error_evaluation(e)
 
+        self._store_evaluation(transcript, user_goal, evaluation)
+        return evaluation
+
+    async def evaluate_conversation_async(self, conversation_history: List[Dict], user_goal: str = None) -> Dict:
+        """Async version of evaluate_conversation for concurrent simulations."""
+        transcript = self._format_transcript(conversation_history)
+
+        cached = await self._cached_evaluation_async(transcript, user_goal)
+        if cached is not None:
+            return cached
+
+        prompt = self._build_judge_prompt(transcript, user_goal)
+
+        try:
+            response = await self._request_evaluation_async(prompt)
+            evaluation = self._parse_evaluation(response)
         except Exception as e:
-            # Return a fallback evaluation on error
-            return {
-                "error": str(e),
-                "technical_failures": {"score": 5, "justification": "Judge failed to evaluate", "confidence": 0.0},
-                "overall_summary": f"Evaluation error: {str(e)}",
-                "primary_failure_mode": "Technical - Evaluation system failure",
-                "suggestion": "Review evaluation system logs"
-            }
+            return self._error_evaluation(e)
+
+        self._store_evaluation(transcript, user_goal, evaluation)
+        return evaluation
+
+    async def evaluate_batch_async(self, conversations: List[Tuple[List[Dict], str]]) -> List[Dict]:
+        """
+        Evaluate several conversations in a single judge call.
+
+        Short transcripts cost little next to the fixed rubric, so packing
+        them into one request saves calls. Conversations that are already
+        cached are not sent; if the batched verdicts cannot be used, each
+        conversation is evaluated on its own instead.
+
+        Args:
+            conversations: List of (conversation_history, user_goal) tuples
+
+        Returns:
+            Evaluations, in the same order as conversations
+        """
+        transcripts = [self._format_transcript(history) for history, _ in conversations]
+        evaluations = [
+            await self._cached_evaluation_async(transcript, user_goal)
+            for transcript, (_, user_goal) in zip(transcripts, conversations)
+        ]
+        pending = [i for i, evaluation in enumerate(evaluations) if evaluation is None]
+
+        if len(pending) == 1:
+            i = pending[0]
+            evaluations[i] = await self.evaluate_conversation_async(*conversations[i])
+        elif pending:
+            prompt = self._build_batch_prompt([(transcripts[i], conversations[i][1]) for i in pending])
+            try:
+                response = await self._request_evaluation_async(prompt, batch_size=len(pending))
+                batch_evaluations = self._parse_batch_evaluation(response, len(pending))
+            except Exception:
+                batch_evaluations = None
+
+            if batch_evaluations is None:
+                # Fall back to judging each conversation separately
+                batch_evaluations = await asyncio.gather(*[
+                    self.evaluate_conversation_async(*conversations[i]) for i in pending
+                ])
+            else:
+                for i, evaluation in zip(pending, batch_evaluations):
+                    self._store_evaluation(transcripts[i], conversations[i][1], evaluation)
+
+            for i, evaluation in zip(pending, batch_evaluations):
+                evaluations[i] = evaluation
+
+        return evaluations
+
+    def _request_evaluation(self, prompt: str):
+        """
+        Call the judge, widening max_tokens if the verdict is truncated.
+
+        Raises ValueError if the verdict is still truncated at the largest
+        budget, so a partial verdict is never parsed or cached.
+        """
+        for max_tokens in _MAX_TOKENS_STEPS:
+            # Long JSON verdicts are streamed rather than awaited as one body
+            response = stream_message(self.client, self._build_request(prompt, max_tokens))
+            if response.stop_reason != "max_tokens":
+                return response
+        raise ValueError(f"Judge verdict truncated at max_tokens={max_tokens}")
+
+    async def _request_evaluation_async(self, prompt: str, batch_size: int = None):
+        """Async version of _request_evaluation; batch_size scales the budget for batched verdicts."""
+        if batch_size:
+            # Scaled budgets collapse once they reach the output cap; each
+            # distinct budget is tried once
+            budgets = sorted({min(max_tokens * batch_size, _MAX_OUTPUT_TOKENS) for max_tokens in _MAX_TOKENS_STEPS})
+        else:
+            budgets = _MAX_TOKENS_STEPS
+
+        for max_tokens in budgets:
+            if batch_size:
+                request = self._build_request(prompt, max_tokens, BATCH_EVAL_TOOL)
+            else:
+                request = self._build_request(prompt, max_tokens)
+            response = await stream_message_async(self.async_client, request)
+            if response.stop_reason != "max_tokens":
+                return response
+        raise ValueError(f"Judge verdict truncated at max_tokens={max_tokens}")
+
+    def _cached_evaluation(self, transcript: str, user_goal: str = None) -> Dict:
+        """Return a cached evaluation for this transcript, or None on miss."""
+        evaluation = self._exact_evaluation(transcript, user_goal)
+        if evaluation is None and self.cache is not None:
+            evaluation = self.cache.get_evaluation(transcript, user_goal)
+        return self._cache_hit(evaluation)
+
+    async def _cached_evaluation_async(self, transcript: str, user_goal: str = None) -> Dict:
+        """Async version of _cached_evaluation; semantic lookups run off the event loop."""
+        evaluation = self._exact_evaluation(transcript, user_goal)
+        if evaluation is None and self.cache is not None:
+            evaluation = await self.cache.get_evaluation_async(transcript, user_goal)
+        return self._cache_hit(evaluation)
+
+    def _exact_evaluation(self, transcript: str, user_goal: str = None) -> Dict:
+        key = self._transcript_hash(transcript, user_goal)
+        evaluation = self._exact_cache.get(key)
+        if evaluation is not None:
+            self._exact_cache.move_to_end(key)
+        return evaluation
+
+    def _cache_hit(self, evaluation: Dict) -> Dict:
+        if evaluation is None:
+            return None
+        # No tokens were spent on this evaluation
+        return {**evaluation, "meta": {"model": self.model, "tokens_used": 0, "cache_hit": True}}
+
+    def _store_evaluation(self, transcript: str, user_goal: str, evaluation: Dict):
+        key = self._transcript_hash(transcript, user_goal)
+        self._exact_cache[key] = evaluation
+        self._exact_cache.move_to_end(key)
+        if len(self._exact_cache) > self.exact_cache_size:
+            self._exact_cache.popitem(last=False)
+        if self.cache is not None:
+            self.cache.put_evaluation(transcript, user_goal, evaluation)
+
+    def _transcript_hash(self, transcript: str, user_goal: str = None) -> str:
+        return hashlib.sha256((transcript + "\n" + (user_goal or "")).encode("utf-8")).hexdigest()
+
+    def _build_request(self, prompt: str, max_tokens: int = _MAX_TOKENS_STEPS[0], tool: Dict = EVAL_TOOL) -> Dict:
+        """
+        Build the Claude request: cached static rubric, then the
+        conversation-specific prompt (see _build_judge_prompt).
+        """
+        return {
+            "model": self.model,
+            "max_tokens": max_tokens,
+            "system": "You are an expert evaluator assessing AI customer support agent performance.",
+            "tools": [tool],
+            "tool_choice": {"type": "tool", "name": tool["name"]},
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": RUBRIC_STATIC,
+                            "cache_control": {"type": "ephemeral"}
+                        },
+                        {"type": "text", "text": prompt}
+                    ]
+                }
+            ]
+        }
+
+    def _parse_evaluation(self, response) -> Dict:
+        """Extract the judge's verdict from the emit_evaluation tool call."""
+        tool_use = next(block for block in response.content if block.type == "tool_use")
+        evaluation = dict(tool_use.input)
+
+        # Add metadata
+        evaluation["meta"] = {
+            "model": self.model,
+            "tokens_used": response.usage.input_tokens + response.usage.output_tokens,
+            "cache_creation_input_tokens": getattr(response.usage, "cache_creation_input_tokens", 0) or 0,
+            "cache_read_input_tokens": getattr(response.usage, "cache_read_input_tokens", 0) or 0
+        }
+
+        return evaluation
+
+    def _parse_batch_evaluation(self, response, count: int) -> List[Dict]:
+        """Verdicts from an emit_evaluations call, or None if there is not one per conversation."""
+        tool_use = next(block for block in response.content if block.type == "tool_use")
+        evaluations = tool_use.input.get("evaluations")
+        if not isinstance(evaluations, list) or len(evaluations) != count:
+            return None
+
+        # Tokens are shared by the whole batch; attribute an equal share to each
+        meta = {
+            "model": self.model,
+            "tokens_used": (response.usage.input_tokens + response.usage.output_tokens) // count,
+            "batch_size": count
+        }
+        return [{**evaluation, "meta": meta} for evaluation in evaluations]
+
+    def _error_evaluation(self, error: Exception) -> Dict:
+        """Fallback evaluation returned when the judge call or parsing fails."""
+        return {
+            "error": str(error),
+            "technical_failures": {"score": 5, "justification": "Judge failed to evaluate", "confidence": 0.0},
+            "overall_summary": f"Evaluation error: {str(error)}",
+            "primary_failure_mode": "Technical - Evaluation system failure",
+            "suggestion": "Review evaluation system logs"
+        }
 
     def _format_transcript(self, conversation_history: List[Dict]) -> str:
         """Format conversation history into readable transcript."""
-        lines = []
-        for msg in conversation_history:
-            role = msg.get("role", "unknown")
-            content = msg.get("content", "")
+        return "\n\n".join(
+            f"{_ROLE_MAP[msg['role']]}: {msg.get('content', '')}"
+            for msg in conversation_history
+            if msg.get("role") in _ROLE_MAP
+        )
 
-            if role == "user":
-                lines.append(f"USER: {content}")
-            elif role == "assistant":
-                lines.append(f"AGENT: {content}")
+    def _build_judge_prompt(self, transcript: str, user_goal: str = None) -> str:
+        """Build the per-conversation part of the evaluation prompt (goal and transcript)."""
+        goal_section = f"User's Goal: {user_goal}\n\n" if user_goal else ""
+        return _JUDGE_PROMPT.format(goal_section=goal_section, transcript=transcript)
 
-        return "\n\n".join(lines)
+    def _build_batch_prompt(self, conversations: List[Tuple[str, str]]) -> str:
+        """Per-batch part of the prompt: each (transcript, goal) in a numbered block."""
+        blocks = []
+        for i, (transcript, user_goal) in enumerate(conversations):
+            goal_section = f"User's Goal: {user_goal}\n\n" if user_goal else ""
+            blocks.append(f'<conversation id="{i}">\n{goal_section}{transcript}\n</conversation>')
 
-    def _build_judge_prompt(self, transcript: str, user_goal: str = None) -> str:
-        """Build the evaluation prompt for the judge."""
-        goal_section = f"\nUser's Goal: {user_goal}\n" if user_goal else ""
-
-        return f"""You are an expert evaluator assessing the performance of an AI Customer Support Agent.
-
-            Given the conversation transcript below, evaluate the interaction across the following 12 categories of failure.
-            For each category, assign:
-            - A **score from 0-5** (0 = perfect, 5 = critical failure)
-            - A **short justification** (1-2 sentences)
-            - A **confidence level** (0-1)
-
-            Categories:
-            1. technical_failures: Downtime, latency, API issues, data quality
-            2. comprehension_failures: Intent misclassification, entity extraction, context loss
-            3. response_quality_failures: Hallucinations, irrelevant responses, contradictions
-            4. knowledge_failures: Knowledge gaps, outdated info, retrieval failures
-            5. task_execution_failures: Action failures, workflow errors, authorization issues
-            6. interaction_design_failures: Inappropriate tone, cultural insensitivity
-            7. safety_compliance_failures: Privacy breaches, security vulnerabilities
-            8. escalation_boundary_failures: Over-confidence, premature escalation
-            9. user_experience_failures: Frustration amplification, expectation mismatch
-            10. business_logic_failures: Policy misapplication, exception handling errors
-            11. meta_cognitive_failures: Calibration errors, self-awareness gaps
-            12. temporal_failures: State management, timing errors, sequencing failures
-
-            Then, provide:
-            1. overall_summary: Brief summary of the conversation quality
-            2. primary_failure_mode: The single most significant failure (if any)
-            3. suggestion: One actionable improvement recommendation
-            {goal_section}
-            Return ONLY valid JSON in this exact format (no additional text):
-
-            {{
-            "technical_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "comprehension_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "response_quality_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "knowledge_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "task_execution_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "interaction_design_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "safety_compliance_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "escalation_boundary_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "user_experience_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "business_logic_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "meta_cognitive_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "temporal_failures": {{"score": 0, "justification": "...", "confidence": 0.9}},
-            "overall_summary": "...",
-            "primary_failure_mode": "...",
-            "suggestion": "..."
-            }}
-
-            [Transcript begins below]
-
-            {transcript}
-        """
+        return (
+            f"Evaluate each of the following {len(conversations)} conversations separately, "
+            "and return one evaluation per conversation, in order, with the emit_evaluations tool.\n\n"
+            + "\n\n".join(blocks)
+        )
+
+
+class BatchCollector:
+    """
+    Groups judge requests from concurrent simulations into evaluate_batch_async calls.
+
+    A batch is sent once it holds max_batch_size conversations or
+    max_batch_chars characters of messages, or batch_timeout seconds after
+    its first conversation arrived, whichever comes first.
+    """
+
+    def __init__(
+        self,
+        judge: LLMJudge,
+        max_batch_size: int = 8,
+        batch_timeout: float = 0.2,
+        max_batch_chars: int = 6000
+    ):
+        self.judge = judge
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.max_batch_chars = max_batch_chars
+        self._pending = []  # (conversation_history, user_goal, future)
+        self._pending_chars = 0
+        self._timer = None
+        self._tasks = set()
+
+    def evaluate(self, conversation_history: List[Dict], user_goal: str = None) -> Awaitable[Dict]:
+        """Queue a conversation for evaluation; await the result for its evaluation."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        chars = sum(len(str(msg.get("content", ""))) for msg in conversation_history)
+
+        # Keep batches under the size budget
+        if self._pending and self._pending_chars + chars > self.max_batch_chars:
+            self._flush()
+
+        self._pending.append((conversation_history, user_goal, future))
+        self._pending_chars += chars
+
+        if len(self._pending) >= self.max_batch_size or self._pending_chars >= self.max_batch_chars:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_timeout, self._flush)
+
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending, self._pending_chars = self._pending, [], 0
+        if batch:
+            task = asyncio.create_task(self._evaluate(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _evaluate(self, batch: List[tuple]):
+        try:
+            evaluations = await self.judge.evaluate_batch_async([(history, goal) for history, goal, _ in batch])
+        except Exception as e:
+            evaluations = [self.judge._error_evaluation(e)] * len(batch)
+
+        for (_, _, future), evaluation in zip(batch, evaluations):
+            if not future.done():
+                future.set_result(evaluation)
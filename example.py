@@ -4,6 +4,7 @@ Quick example demonstrating the evaluation platform.
 Run this after setting up your .env file with ANTHROPIC_API_KEY.
 """
 
+import asyncio
 import os
 from dotenv import load_dotenv
 from orchestrator.simulator import EvaluationOrchestrator
@@ -60,7 +61,7 @@ def main():
     # print("Running 5 simulations...")
     # print("=" * 80)
     #
-    # results = orchestrator.run_batch_simulations(num_simulations=5)
+    # results = asyncio.run(orchestrator.run_batch_simulations(num_simulations=5))
     #
     # print("\nGENERATING REPORT...")
     # report = reporter.generate_report(results)
@@ -2,29 +2,34 @@
 Results aggregation and reporting.
 """
 
-import json
-from typing import List, Dict
-from collections import defaultdict
+import io
+from operator import itemgetter
+from typing import AsyncIterable, Dict, List, Sequence
+
+import numpy as np
+import orjson
+
+from evaluators.judge import FAILURE_CATEGORIES
+
+# Output files are written through a 64KB buffer: results and reports are
+# written in many small pieces
+WRITE_BUFFER_SIZE = 1 << 16
+
+# Results may carry numpy values (e.g. from custom post-processing);
+# orjson encodes them natively instead of failing on them
+RESULTS_DUMPS_OPTION = orjson.OPT_SERIALIZE_NUMPY
 
 
 class EvaluationReporter:
     """Aggregates and reports on evaluation results."""
 
-    def __init__(self):
-        self.failure_categories = [
-            "technical_failures",
-            "comprehension_failures",
-            "response_quality_failures",
-            "knowledge_failures",
-            "task_execution_failures",
-            "interaction_design_failures",
-            "safety_compliance_failures",
-            "escalation_boundary_failures",
-            "user_experience_failures",
-            "business_logic_failures",
-            "meta_cognitive_failures",
-            "temporal_failures"
-        ]
+    def __init__(self, incremental_chunk_size: int = 256):
+        self.failure_categories = FAILURE_CATEGORIES
+        # Running totals for update_incremental; results are folded in
+        # chunks of incremental_chunk_size
+        self.incremental_chunk_size = incremental_chunk_size
+        self._incremental_state = self._empty_partial()
+        self._incremental_buffer = []
 
     def aggregate_results(self, results: List[Dict]) -> Dict:
         """
@@ -36,41 +41,141 @@ class EvaluationReporter:
         Returns:
             Aggregated statistics and insights
         """
-        if not results:
-            return {"error": "No results to aggregate"}
-
-        # Filter out error results
-        valid_results = [r for r in results if "error" not in r]
-        error_results = [r for r in results if "error" in r]
+        return self.finalize_aggregate(self.aggregate_partial(results, self.failure_categories))
 
-        if not valid_results:
-            return {"error": "No valid results to aggregate"}
-
-        # Basic stats
-        total_simulations = len(results)
-        successful_simulations = len(valid_results)
-        failed_simulations = len(error_results)
-
-        # Goal completion stats
-        goal_met_count = sum(1 for r in valid_results if r.get("goal_met", False))
-        giving_up_count = sum(1 for r in valid_results if r.get("giving_up", False))
-
-        # Average turns
-        avg_turns = sum(r.get("turns", 0) for r in valid_results) / len(valid_results) if valid_results else 0
+    def update_incremental(self, result: Dict):
+        """
+        Fold one result into the running totals, e.g. as a streamed batch
+        produces it. Results are only buffered until a chunk is full, so
+        memory stays bounded however large the batch.
+        """
+        self._incremental_buffer.append(result)
+        if len(self._incremental_buffer) >= self.incremental_chunk_size:
+            self._fold_incremental()
+
+    def aggregate_state(self) -> Dict:
+        """aggregate_results output for everything passed to update_incremental."""
+        self._fold_incremental()
+        return self.finalize_aggregate(self._incremental_state)
+
+    def _fold_incremental(self):
+        if self._incremental_buffer:
+            chunk = self.aggregate_partial(self._incremental_buffer, self.failure_categories)
+            self._incremental_state = self.merge_partials([self._incremental_state, chunk])
+            self._incremental_buffer = []
+
+    @staticmethod
+    def aggregate_partial(results: List[Dict], failure_categories: Sequence[str]) -> Dict:
+        """
+        Reduce a chunk of results to mergeable running totals.
 
-        # Aggregate scores by failure category
-        category_scores = defaultdict(list)
-        for result in valid_results:
+        A static function of plain data so chunks can be aggregated in worker
+        processes while later simulations are still running; combine chunks
+        with merge_partials and turn the totals into statistics with
+        finalize_aggregate.
+        """
+        partial = EvaluationReporter._empty_partial()
+
+        # Error results only count towards the totals
+        valid = [result for result in results if "error" not in result]
+        n = len(valid)
+        partial["total"] = len(results)
+        partial["failed"] = len(results) - n
+        partial["successful"] = n
+        if not n:
+            return partial
+
+        goal_met = np.fromiter((bool(r.get("goal_met", False)) for r in valid), dtype=bool, count=n)
+        giving_up = np.fromiter((bool(r.get("giving_up", False)) for r in valid), dtype=bool, count=n)
+        turns = np.fromiter((r.get("turns", 0) for r in valid), dtype=np.float64, count=n)
+
+        # Scores by failure category as an [n, categories] matrix, filled in
+        # one pass; `present` marks categories the evaluation included
+        scores = np.zeros((n, len(failure_categories)))
+        present = np.zeros((n, len(failure_categories)), dtype=bool)
+        failure_modes = partial["failure_modes"]
+        for row, result in enumerate(valid):
             evaluation = result.get("evaluation", {})
-            for category in self.failure_categories:
+            for col, category in enumerate(failure_categories):
                 if category in evaluation:
-                    score = evaluation[category].get("score", 0)
-                    category_scores[category].append(score)
+                    present[row, col] = True
+                    scores[row, col] = evaluation[category].get("score", 0)
+
+            # Primary failure modes
+            primary_failure = evaluation.get("primary_failure_mode", "Unknown")
+            failure_modes[primary_failure] = failure_modes.get(primary_failure, 0) + 1
+
+        partial["goal_met"] = int(goal_met.sum())
+        partial["giving_up"] = int(giving_up.sum())
+        partial["turns"] = int(turns.sum())
+
+        # Category totals: [sum, count], keyed in the order categories first appear
+        score_sums = scores.sum(axis=0)
+        score_counts = present.sum(axis=0)
+        seen = np.flatnonzero(score_counts)
+        first_rows = present.argmax(axis=0)[seen]
+        for col in seen[np.lexsort((seen, first_rows))]:
+            partial["category_scores"][failure_categories[col]] = [score_sums[col].item(), int(score_counts[col])]
+
+        # Per-dimension totals: [count, goal_met, turns, total_score], grouped
+        # with bincount over keys numbered in first-seen order
+        total_scores = scores.sum(axis=1)
+        for dimension, breakdown in partial["dimensions"].items():
+            index = {}
+            codes = np.fromiter(
+                (index.setdefault(r.get(dimension, "unknown"), len(index)) for r in valid),
+                dtype=np.intp,
+                count=n
+            )
+            counts = np.bincount(codes, minlength=len(index))
+            goal_met_counts = np.bincount(codes, weights=goal_met, minlength=len(index))
+            turn_sums = np.bincount(codes, weights=turns, minlength=len(index))
+            score_totals = np.bincount(codes, weights=total_scores, minlength=len(index))
+            for key, i in index.items():
+                breakdown[key] = [int(counts[i]), int(goal_met_counts[i]), int(turn_sums[i]), score_totals[i].item()]
+
+        return partial
+
+    @staticmethod
+    def merge_partials(partials: List[Dict]) -> Dict:
+        """Combine partial aggregates (in order) into a single partial."""
+        merged = EvaluationReporter._empty_partial()
+
+        for partial in partials:
+            for field in ("total", "failed", "successful", "goal_met", "giving_up", "turns"):
+                merged[field] += partial[field]
+
+            for category, (score_sum, count) in partial["category_scores"].items():
+                totals = merged["category_scores"].setdefault(category, [0, 0])
+                totals[0] += score_sum
+                totals[1] += count
+
+            for dimension, breakdown in partial["dimensions"].items():
+                for key, values in breakdown.items():
+                    totals = merged["dimensions"][dimension].setdefault(key, [0, 0, 0, 0])
+                    for i, value in enumerate(values):
+                        totals[i] += value
+
+            for failure_mode, count in partial["failure_modes"].items():
+                merged["failure_modes"][failure_mode] = merged["failure_modes"].get(failure_mode, 0) + count
+
+        return merged
+
+    @staticmethod
+    def finalize_aggregate(partial: Dict) -> Dict:
+        """Turn (merged) running totals into the aggregated statistics."""
+        if not partial["total"]:
+            return {"error": "No results to aggregate"}
+
+        successful_simulations = partial["successful"]
+        if not successful_simulations:
+            return {"error": "No valid results to aggregate"}
 
         # Calculate average scores and identify problem areas
-        avg_category_scores = {}
-        for category, scores in category_scores.items():
-            avg_category_scores[category] = sum(scores) / len(scores) if scores else 0
+        avg_category_scores = {
+            category: score_sum / count if count else 0
+            for category, (score_sum, count) in partial["category_scores"].items()
+        }
 
         # Identify worst performing categories (highest scores = worst performance)
         worst_categories = sorted(
@@ -79,154 +184,166 @@ class EvaluationReporter:
             reverse=True
         )[:5]
 
-        # Aggregate by scenario
-        scenario_stats = self._aggregate_by_dimension(valid_results, "scenario_id")
-
-        # Aggregate by personality
-        personality_stats = self._aggregate_by_dimension(valid_results, "personality_id")
-
-        # Collect primary failure modes
-        failure_mode_counts = defaultdict(int)
-        for result in valid_results:
-            evaluation = result.get("evaluation", {})
-            primary_failure = evaluation.get("primary_failure_mode", "Unknown")
-            failure_mode_counts[primary_failure] += 1
-
         top_failure_modes = sorted(
-            failure_mode_counts.items(),
+            partial["failure_modes"].items(),
             key=lambda x: x[1],
             reverse=True
         )[:10]
 
         return {
             "summary": {
-                "total_simulations": total_simulations,
+                "total_simulations": partial["total"],
                 "successful_simulations": successful_simulations,
-                "failed_simulations": failed_simulations,
-                "goal_met_rate": goal_met_count / successful_simulations if successful_simulations > 0 else 0,
-                "giving_up_rate": giving_up_count / successful_simulations if successful_simulations > 0 else 0,
-                "avg_conversation_turns": round(avg_turns, 2)
+                "failed_simulations": partial["failed"],
+                "goal_met_rate": partial["goal_met"] / successful_simulations,
+                "giving_up_rate": partial["giving_up"] / successful_simulations,
+                "avg_conversation_turns": round(partial["turns"] / successful_simulations, 2)
             },
             "failure_analysis": {
                 "avg_scores_by_category": avg_category_scores,
                 "worst_performing_categories": worst_categories,
                 "top_failure_modes": top_failure_modes
             },
-            "scenario_breakdown": scenario_stats,
-            "personality_breakdown": personality_stats
+            "scenario_breakdown": EvaluationReporter._finalize_dimension(partial["dimensions"]["scenario_id"]),
+            "personality_breakdown": EvaluationReporter._finalize_dimension(partial["dimensions"]["personality_id"])
         }
 
-    def _aggregate_by_dimension(self, results: List[Dict], dimension: str) -> Dict:
-        """Aggregate results by a specific dimension (scenario_id or personality_id)."""
-        dimension_data = defaultdict(lambda: {
-            "count": 0,
+    @staticmethod
+    def _empty_partial() -> Dict:
+        return {
+            "total": 0,
+            "failed": 0,
+            "successful": 0,
             "goal_met": 0,
-            "avg_turns": 0,
-            "avg_total_score": 0
-        })
-
-        for result in results:
-            key = result.get(dimension, "unknown")
-            dimension_data[key]["count"] += 1
-
-            if result.get("goal_met", False):
-                dimension_data[key]["goal_met"] += 1
-
-            dimension_data[key]["avg_turns"] += result.get("turns", 0)
-
-            # Calculate total score across all categories
-            evaluation = result.get("evaluation", {})
-            total_score = 0
-            for category in self.failure_categories:
-                if category in evaluation:
-                    total_score += evaluation[category].get("score", 0)
-            dimension_data[key]["avg_total_score"] += total_score
-
-        # Calculate averages
-        for key, data in dimension_data.items():
-            count = data["count"]
-            data["goal_met_rate"] = data["goal_met"] / count if count > 0 else 0
-            data["avg_turns"] = round(data["avg_turns"] / count, 2) if count > 0 else 0
-            data["avg_total_score"] = round(data["avg_total_score"] / count, 2) if count > 0 else 0
-            del data["goal_met"]  # Remove raw count
-
-        return dict(dimension_data)
+            "giving_up": 0,
+            "turns": 0,
+            "category_scores": {},
+            "dimensions": {"scenario_id": {}, "personality_id": {}},
+            "failure_modes": {}
+        }
 
-    def generate_report(self, results: List[Dict], output_file: str = None) -> str:
+    @staticmethod
+    def _finalize_dimension(breakdown: Dict) -> Dict:
+        """Per-dimension averages (by scenario_id or personality_id)."""
+        dimension_stats = {}
+        for key, (count, goal_met, turns, total_score) in breakdown.items():
+            dimension_stats[key] = {
+                "count": count,
+                "avg_turns": round(turns / count, 2) if count > 0 else 0,
+                "avg_total_score": round(total_score / count, 2) if count > 0 else 0,
+                "goal_met_rate": goal_met / count if count > 0 else 0
+            }
+        return dimension_stats
+
+    def generate_report(self, results: List[Dict], output_file: str = None, aggregated: Dict = None) -> str:
         """
         Generate a formatted report from results.
 
         Args:
             results: List of simulation results
             output_file: Optional file path to save report
+            aggregated: Precomputed aggregate_results output (optional)
 
         Returns:
             Formatted report as string
         """
-        aggregated = self.aggregate_results(results)
+        if aggregated is None:
+            aggregated = self.aggregate_results(results)
 
-        report_lines = []
-        report_lines.append("=" * 80)
-        report_lines.append("AI CUSTOMER SUPPORT EVALUATION REPORT")
-        report_lines.append("=" * 80)
-        report_lines.append("")
+        buf = io.StringIO()
+        w = buf.write
+        w("=" * 80 + "\n")
+        w("AI CUSTOMER SUPPORT EVALUATION REPORT\n")
+        w("=" * 80 + "\n")
+        w("\n")
 
         # Summary section
         summary = aggregated.get("summary", {})
-        report_lines.append("SUMMARY")
-        report_lines.append("-" * 80)
-        report_lines.append(f"Total Simulations: {summary.get('total_simulations', 0)}")
-        report_lines.append(f"Successful: {summary.get('successful_simulations', 0)}")
-        report_lines.append(f"Failed: {summary.get('failed_simulations', 0)}")
-        report_lines.append(f"Goal Met Rate: {summary.get('goal_met_rate', 0):.2%}")
-        report_lines.append(f"User Gave Up Rate: {summary.get('giving_up_rate', 0):.2%}")
-        report_lines.append(f"Avg Conversation Turns: {summary.get('avg_conversation_turns', 0)}")
-        report_lines.append("")
+        w("SUMMARY\n")
+        w("-" * 80 + "\n")
+        w(f"Total Simulations: {summary.get('total_simulations', 0)}\n")
+        w(f"Successful: {summary.get('successful_simulations', 0)}\n")
+        w(f"Failed: {summary.get('failed_simulations', 0)}\n")
+        w(f"Goal Met Rate: {summary.get('goal_met_rate', 0):.2%}\n")
+        w(f"User Gave Up Rate: {summary.get('giving_up_rate', 0):.2%}\n")
+        w(f"Avg Conversation Turns: {summary.get('avg_conversation_turns', 0)}\n")
+        w("\n")
 
         # Failure analysis
         failure_analysis = aggregated.get("failure_analysis", {})
-        report_lines.append("FAILURE ANALYSIS")
-        report_lines.append("-" * 80)
-        report_lines.append("Worst Performing Categories (0=perfect, 5=critical):")
+        w("FAILURE ANALYSIS\n")
+        w("-" * 80 + "\n")
+        w("Worst Performing Categories (0=perfect, 5=critical):\n")
         for category, score in failure_analysis.get("worst_performing_categories", []):
-            report_lines.append(f"  {category}: {score:.2f}")
-        report_lines.append("")
+            w(f"  {category}: {score:.2f}\n")
+        w("\n")
 
-        report_lines.append("Top Failure Modes:")
+        w("Top Failure Modes:\n")
         for failure_mode, count in failure_analysis.get("top_failure_modes", []):
-            report_lines.append(f"  {failure_mode}: {count} occurrences")
-        report_lines.append("")
-
-        # Scenario breakdown
-        report_lines.append("SCENARIO BREAKDOWN")
-        report_lines.append("-" * 80)
-        scenario_breakdown = aggregated.get("scenario_breakdown", {})
-        for scenario_id, stats in sorted(scenario_breakdown.items(), key=lambda x: x[1]["avg_total_score"], reverse=True):
-            report_lines.append(f"{scenario_id}:")
-            report_lines.append(f"  Count: {stats['count']}, Goal Met: {stats['goal_met_rate']:.2%}, Avg Score: {stats['avg_total_score']:.2f}")
-        report_lines.append("")
-
-        # Personality breakdown
-        report_lines.append("PERSONALITY BREAKDOWN")
-        report_lines.append("-" * 80)
-        personality_breakdown = aggregated.get("personality_breakdown", {})
-        for personality_id, stats in sorted(personality_breakdown.items(), key=lambda x: x[1]["avg_total_score"], reverse=True):
-            report_lines.append(f"{personality_id}:")
-            report_lines.append(f"  Count: {stats['count']}, Goal Met: {stats['goal_met_rate']:.2%}, Avg Score: {stats['avg_total_score']:.2f}")
-        report_lines.append("")
-
-        report_lines.append("=" * 80)
-
-        report = "\n".join(report_lines)
+            w(f"  {failure_mode}: {count} occurrences\n")
+        w("\n")
+
+        # Scenario and personality breakdowns, worst average score first
+        for title, breakdown in (
+            ("SCENARIO BREAKDOWN", aggregated.get("scenario_breakdown", {})),
+            ("PERSONALITY BREAKDOWN", aggregated.get("personality_breakdown", {}))
+        ):
+            w(title + "\n")
+            w("-" * 80 + "\n")
+            items = [(key, stats, stats["avg_total_score"]) for key, stats in breakdown.items()]
+            items.sort(key=itemgetter(2), reverse=True)
+            for key, stats, _ in items:
+                w(f"{key}:\n")
+                w(f"  Count: {stats['count']}, Goal Met: {stats['goal_met_rate']:.2%}, Avg Score: {stats['avg_total_score']:.2f}\n")
+            w("\n")
+
+        w("=" * 80)
+
+        report = buf.getvalue()
 
         # Save to file if specified
         if output_file:
-            with open(output_file, 'w') as f:
+            with open(output_file, 'w', buffering=WRITE_BUFFER_SIZE, encoding='utf-8') as f:
+                f.write(report)
+
+        return report
+
+    def generate_report_bytes(self, results: List[Dict], output_file: str = None, aggregated: Dict = None) -> bytes:
+        """
+        generate_report encoded to UTF-8 once, for writing the same report to
+        binary stdout and to output_file.
+        """
+        report = self.generate_report(results, aggregated=aggregated).encode("utf-8")
+
+        if output_file:
+            with open(output_file, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
                 f.write(report)
 
         return report
 
     def save_results(self, results: List[Dict], output_file: str):
         """Save raw results to JSON file."""
-        with open(output_file, 'w') as f:
-            json.dump(results, f, indent=2)
+        with open(output_file, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | RESULTS_DUMPS_OPTION))
+
+    async def save_results_streaming_async(self, results: AsyncIterable[Dict], output_file: str, jsonl: bool = False):
+        """
+        Save results from an async iterator (e.g. run_batch_streaming) to a
+        JSON array (or JSON Lines) file one result at a time.
+
+        Only one encoded result is held in memory, so the full batch is never
+        built as a list.
+        """
+        with open(output_file, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            if jsonl:
+                async for result in results:
+                    f.write(orjson.dumps(result, option=RESULTS_DUMPS_OPTION | orjson.OPT_APPEND_NEWLINE))
+                return
+
+            f.write(b"[")
+            sep = b""
+            async for result in results:
+                f.write(sep)
+                f.write(orjson.dumps(result, option=RESULTS_DUMPS_OPTION))
+                sep = b","
+            f.write(b"]")
@@ -2,22 +2,58 @@
 Evaluation orchestrator - runs simulations and coordinates agents.
 """
 
+import asyncio
+import os
+import random
 import time
-from typing import Dict, List
+from typing import AsyncIterator, Callable, Dict, Generator, List, Tuple
+
+import orjson
 from agents.customer_support_agent import CustomerSupportAgent
 from agents.user_agent import UserAgent
-from evaluators.judge import LLMJudge
-from config.scenarios import SCENARIOS, PERSONALITIES
+from agents.cache import SemanticCache, SemanticJudgeCache
+from agents.clients import AnthropicPool, default_api_key, default_api_keys
+from evaluators.judge import BatchCollector, LLMJudge
+from config.scenarios import SCENARIOS, PERSONALITIES, get_scenario, get_personality
 
 
 class EvaluationOrchestrator:
     """Orchestrates conversations between user agents and customer support agent."""
 
-    def __init__(self, api_key: str = None):
-        self.support_agent = CustomerSupportAgent(api_key=api_key)
-        self.user_agent = UserAgent(api_key=api_key)
-        self.judge = LLMJudge(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str = None,
+        cache_path: str = None,
+        judge_cache_path: str = None,
+        api_keys: List[str] = None,
+        requests_per_minute: int = None,
+        input_tokens_per_minute: int = None
+    ):
+        # Several API keys (api_keys, or ANTHROPIC_API_KEYS) and/or per-key
+        # rate limits are applied to batch runs through one pool shared by
+        # all three agents
+        api_keys = api_keys or default_api_keys()
+        pool = None
+        if api_keys or requests_per_minute or input_tokens_per_minute:
+            pool = AnthropicPool(
+                api_keys or [api_key or default_api_key()],
+                requests_per_minute=requests_per_minute,
+                input_tokens_per_minute=input_tokens_per_minute
+            )
+
+        self.support_agent = CustomerSupportAgent(api_key=api_key, pool=pool)
+        # cache_path opts in to reusing opening messages, persisted between runs
+        opening_cache = SemanticCache(path=cache_path) if cache_path else None
+        self.user_agent = UserAgent(api_key=api_key, cache=opening_cache, pool=pool)
+        # judge_cache_path opts in to reusing evaluations of near-duplicate transcripts
+        judge_cache = SemanticJudgeCache(path=judge_cache_path) if judge_cache_path else None
+        self.judge = LLMJudge(api_key=api_key, cache=judge_cache, pool=pool)
         self.max_turns = 10  # Maximum conversation turns
+        self.concurrency = 20  # Maximum conversations in flight during a batch
+        self.judge_concurrency = 20  # Maximum judge calls in flight during a batch
+        # Finished conversations allowed to wait for the judge before new
+        # conversations stop starting
+        self.max_pending_judges = 200
 
     def run_single_conversation(
         self,
@@ -36,12 +72,86 @@ class EvaluationOrchestrator:
         Returns:
             Dict with conversation history, evaluation, and metadata
         """
+        steps = self._conversation_steps(scenario, personality, max_turns)
+        try:
+            agent, method, kwargs = next(steps)
+            while True:
+                agent, method, kwargs = steps.send(getattr(agent, method)(**kwargs))
+        except StopIteration as stop:
+            conversation = stop.value
+
+        # Evaluate the conversation
+        evaluation = self.judge.evaluate_conversation(
+            conversation_history=conversation["conversation_history"],
+            user_goal=scenario["goal"]
+        )
+
+        return {
+            **conversation,
+            "evaluation": evaluation,
+            "timestamp": time.time()
+        }
+
+    async def run_single_conversation_async(
+        self,
+        scenario: Dict,
+        personality: Dict,
+        max_turns: int = None,
+        initial_message: str = None
+    ) -> Dict:
+        """
+        Async version of run_single_conversation.
+
+        Turns within a conversation are still sequential; the async API lets
+        many conversations share the event loop while waiting on Claude.
+        A pre-generated initial_message skips the opening-message call.
+        """
+        conversation = await self._run_conversation_async(scenario, personality, max_turns, initial_message)
+        return await self._judge_conversation_async(scenario, conversation)
+
+    async def _run_conversation_async(
+        self,
+        scenario: Dict,
+        personality: Dict,
+        max_turns: int = None,
+        initial_message: str = None
+    ) -> Dict:
+        """Run the conversation itself, without judging it."""
+        steps = self._conversation_steps(scenario, personality, max_turns, initial_message)
+        try:
+            agent, method, kwargs = next(steps)
+            while True:
+                response = await getattr(agent, method + "_async")(**kwargs)
+                agent, method, kwargs = steps.send(response)
+        except StopIteration as stop:
+            return stop.value
+
+    def _conversation_steps(
+        self,
+        scenario: Dict,
+        personality: Dict,
+        max_turns: int = None,
+        initial_message: str = None
+    ) -> Generator[Tuple[object, str, Dict], object, Dict]:
+        """
+        The conversation loop, shared by the sync and async runners.
+
+        Yields (agent, method name, kwargs) for each agent call and is sent
+        the call's result; the sync runner calls the method as named, the
+        async runner its _async twin. Returns the conversation dict.
+        """
         max_turns = max_turns or self.max_turns
         conversation_history = []
         goal = scenario["goal"]
+        # Personality/goal prompt is fixed for the conversation; build it once
+        persona_prompt = self.user_agent.build_persona_prompt(personality, goal)
 
         # Generate initial user message
-        initial_message = self.user_agent.generate_initial_message(personality, scenario)
+        if initial_message is None:
+            initial_message = yield self.user_agent, "generate_initial_message", {
+                "personality": personality,
+                "scenario": scenario
+            }
 
         # Add to conversation history
         conversation_history.append({
@@ -56,16 +166,18 @@ class EvaluationOrchestrator:
         # Conversation loop
         while turns < max_turns and not goal_met and not giving_up:
             # Customer support agent responds
-            support_response = self.support_agent.respond(
-                conversation_history=conversation_history,
-                user_message=initial_message if turns == 0 else conversation_history[-1]["content"],
-                user_profile=personality
-            )
+            # Conversation history is already in Claude message format, so
+            # it is passed as-is and only ever appended to
+            support_response = yield self.support_agent, "respond", {
+                "messages": conversation_history,
+                "user_profile": personality
+            }
 
             # Add agent response to history
+            agent_reply = support_response["response"]
             conversation_history.append({
                 "role": "assistant",
-                "content": support_response["response"]
+                "content": agent_reply
             })
 
             # Check if this was the last turn
@@ -73,12 +185,13 @@ class EvaluationOrchestrator:
                 break
 
             # User agent responds
-            user_response = self.user_agent.generate_response(
-                personality=personality,
-                goal=goal,
-                conversation_history=conversation_history,
-                agent_response=support_response["response"]
-            )
+            user_response = yield self.user_agent, "generate_response", {
+                "personality": personality,
+                "goal": goal,
+                "messages": conversation_history,
+                "agent_response": agent_reply,
+                "persona_prompt": persona_prompt
+            }
 
             # Add user response to history
             conversation_history.append({
@@ -90,67 +203,268 @@ class EvaluationOrchestrator:
             giving_up = user_response["giving_up"]
             turns += 1
 
-        # Evaluate the conversation
-        evaluation = self.judge.evaluate_conversation(
-            conversation_history=conversation_history,
-            user_goal=goal
-        )
-
         return {
             "scenario_id": scenario["id"],
             "personality_id": personality["id"],
             "conversation_history": conversation_history,
             "turns": turns,
             "goal_met": goal_met,
-            "giving_up": giving_up,
+            "giving_up": giving_up
+        }
+
+    async def _judge_conversation_async(
+        self,
+        scenario: Dict,
+        conversation: Dict,
+        collector: BatchCollector = None
+    ) -> Dict:
+        """
+        Evaluate a finished conversation and return the full simulation result.
+
+        With a collector, the conversation is judged together with others
+        in a batched judge call.
+        """
+        evaluate = collector.evaluate if collector else self.judge.evaluate_conversation_async
+        evaluation = await evaluate(
+            conversation_history=conversation["conversation_history"],
+            user_goal=scenario["goal"]
+        )
+
+        return {
+            **conversation,
             "evaluation": evaluation,
             "timestamp": time.time()
         }
 
-    def run_batch_simulations(
+    async def run_batch_simulations(
         self,
         num_simulations: int = 100,
         scenarios: List[Dict] = None,
-        personalities: List[Dict] = None
+        personalities: List[Dict] = None,
+        concurrency: int = None,
+        batch_openings: bool = False,
+        on_result: Callable[[Dict], None] = None,
+        output_jsonl: str = None,
+        seed: int = None,
+        judge_concurrency: int = None,
+        batch_judging: bool = False
     ) -> List[Dict]:
         """
         Run a batch of simulations with different scenarios and personalities.
 
+        Collects run_batch_streaming into a list; see it for the arguments.
+
         Args:
-            num_simulations: Number of simulations to run
-            scenarios: List of scenarios (uses defaults if None)
-            personalities: List of personalities (uses defaults if None)
+            on_result: Called with each result as soon as its simulation
+                finishes (completion order), e.g. for incremental aggregation
 
         Returns:
-            List of simulation results
+            List of simulation results (restored from output_jsonl first,
+            then in completion order)
         """
-        import random
+        results = []
+        async for result in self.run_batch_streaming(
+            num_simulations=num_simulations,
+            scenarios=scenarios,
+            personalities=personalities,
+            concurrency=concurrency,
+            batch_openings=batch_openings,
+            output_jsonl=output_jsonl,
+            seed=seed,
+            judge_concurrency=judge_concurrency,
+            batch_judging=batch_judging
+        ):
+            if on_result:
+                on_result(result)
+            results.append(result)
 
-        scenarios = scenarios or SCENARIOS
-        personalities = personalities or PERSONALITIES
+        return results
 
-        results = []
+    async def run_batch_streaming(
+        self,
+        num_simulations: int = 100,
+        scenarios: List[Dict] = None,
+        personalities: List[Dict] = None,
+        concurrency: int = None,
+        batch_openings: bool = False,
+        output_jsonl: str = None,
+        seed: int = None,
+        judge_concurrency: int = None,
+        batch_judging: bool = False
+    ) -> AsyncIterator[Dict]:
+        """
+        Run a batch of simulations, yielding each result as soon as it finishes.
 
-        for i in range(num_simulations):
-            # Randomly select scenario and personality
-            scenario = random.choice(scenarios)
-            personality = random.choice(personalities)
+        Simulations run concurrently and are pipelined: at most `concurrency`
+        conversations and `judge_concurrency` judge calls are in flight, and a
+        finished conversation frees its slot for the next one while it waits
+        to be judged. Callers that write out or aggregate each result as it
+        arrives never hold the whole batch in memory.
 
-            print(f"Running simulation {i+1}/{num_simulations}: {scenario['id']} with {personality['id']}")
+        Args:
+            num_simulations: Number of simulations to run
+            scenarios: List of scenarios (uses defaults if None)
+            personalities: List of personalities (uses defaults if None)
+            concurrency: Maximum concurrent conversations (optional)
+            batch_openings: Generate all opening messages up-front in one
+                Message Batches API request instead of one call per simulation
+            output_jsonl: Checkpoint file; each result is appended as one JSON
+                line as soon as it finishes, and simulations that already
+                completed there are skipped (resume with the same seed;
+                requires seed)
+            seed: Seed for the scenario/personality selections, so a batch
+                can be reproduced or resumed
+            judge_concurrency: Maximum concurrent judge calls (optional)
+            batch_judging: Judge finished conversations in groups of up to 8
+                per call instead of one call each
+
+        Yields:
+            Simulation results (restored from output_jsonl first, then in
+            completion order)
+        """
+        if output_jsonl and seed is None:
+            raise ValueError("output_jsonl requires a seed to match checkpointed simulations on resume")
 
+        scenarios = scenarios or SCENARIOS
+        personalities = personalities or PERSONALITIES
+        conversation_slots = asyncio.Semaphore(concurrency or self.concurrency)
+        judge_slots = asyncio.Semaphore(judge_concurrency or self.judge_concurrency)
+        judge_backlog = asyncio.Semaphore(self.max_pending_judges)
+        collector = BatchCollector(self.judge) if batch_judging else None
+
+        async def run_one(
+            i: int,
+            scenario: Dict,
+            personality: Dict,
+            simulation_seed: int,
+            initial_message: str = None
+        ) -> Dict:
             try:
-                result = self.run_single_conversation(scenario, personality)
-                results.append(result)
+                async with conversation_slots:
+                    print(f"Running simulation {i+1}/{num_simulations}: {scenario['id']} with {personality['id']}")
+                    conversation = await self._run_conversation_async(
+                        scenario, personality, initial_message=initial_message
+                    )
+                    # Backpressure: hold this conversation slot while the
+                    # judge backlog is full
+                    await judge_backlog.acquire()
+
+                try:
+                    async with judge_slots:
+                        result = await self._judge_conversation_async(scenario, conversation, collector)
+                finally:
+                    judge_backlog.release()
             except Exception as e:
                 print(f"Error in simulation {i+1}: {str(e)}")
-                results.append({
+                result = {
                     "scenario_id": scenario["id"],
                     "personality_id": personality["id"],
                     "error": str(e),
                     "timestamp": time.time()
-                })
-
-        return results
+                }
+
+            result["seed"] = simulation_seed
+            return result
+
+        # Randomly select scenario and personality for each simulation; the
+        # per-simulation seed identifies the run in checkpoint files
+        rng = random.Random(seed)
+        selections = [
+            (rng.choice(scenarios), rng.choice(personalities), rng.getrandbits(32))
+            for _ in range(num_simulations)
+        ]
+
+        pending = list(enumerate(selections))
+        if output_jsonl:
+            completed = self._load_checkpoint(output_jsonl)
+            pending = []
+            restored_count = 0
+            for i, (scenario, personality, simulation_seed) in enumerate(selections):
+                restored = completed.get((scenario["id"], personality["id"], simulation_seed))
+                if restored is None:
+                    pending.append((i, (scenario, personality, simulation_seed)))
+                    continue
+                restored_count += 1
+                yield restored
+            # Restored results have been handed over; don't keep them alive
+            # for the rest of the batch
+            del completed
+            if restored_count:
+                print(f"Skipping {restored_count} simulations already completed in {output_jsonl}")
+
+        initial_messages = {}
+        if batch_openings and pending:
+            openings = await self.user_agent.generate_initial_messages_batch(
+                [(personality, scenario) for _, (scenario, personality, _) in pending]
+            )
+            initial_messages = {i: opening for (i, _), opening in zip(pending, openings)}
+
+        # Simulations are started lazily: only as many tasks as can make
+        # progress (conversation slots plus the judge backlog) exist at once,
+        # and a finished task is dropped as soon as its result is handed over
+        remaining = iter(pending)
+        max_running = (concurrency or self.concurrency) + self.max_pending_judges
+        running = set()
+
+        def start_more():
+            while len(running) < max_running:
+                item = next(remaining, None)
+                if item is None:
+                    return
+                i, (scenario, personality, simulation_seed) = item
+                running.add(asyncio.ensure_future(
+                    run_one(i, scenario, personality, simulation_seed, initial_messages.pop(i, None))
+                ))
+
+        checkpoint = self._open_checkpoint(output_jsonl) if output_jsonl else None
+        try:
+            start_more()
+            while running:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                running -= done
+                start_more()
+                for task in done:
+                    result = task.result()
+                    if checkpoint:
+                        checkpoint.write(orjson.dumps(result) + b"\n")
+                        checkpoint.flush()
+                    yield result
+        finally:
+            # The consumer may stop early; don't leave simulations running
+            for task in running:
+                task.cancel()
+            if checkpoint:
+                checkpoint.close()
+
+    def _open_checkpoint(self, path: str):
+        """Open a JSONL checkpoint for appending, after any partially written line."""
+        checkpoint = open(path, "ab")
+        if checkpoint.tell():
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    checkpoint.write(b"\n")
+        return checkpoint
+
+    def _load_checkpoint(self, path: str) -> Dict[tuple, Dict]:
+        """Successful results in a JSONL checkpoint, keyed by (scenario_id, personality_id, seed)."""
+        completed = {}
+        if not os.path.exists(path):
+            return completed
+
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    result = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # Partially written line from an interrupted run
+
+                # Failed simulations are retried
+                if "error" in result or "seed" not in result:
+                    continue
+                completed[(result["scenario_id"], result["personality_id"], result["seed"])] = result
+
+        return completed
 
     def run_targeted_test(
         self,
@@ -169,38 +483,49 @@ class EvaluationOrchestrator:
         Returns:
             List of simulation results
         """
+        scenario, personalities = self._targeted_selection(scenario_id, personality_id, all_personalities)
+        return [self.run_single_conversation(scenario, personality) for personality in personalities]
+
+    async def run_targeted_test_async(
+        self,
+        scenario_id: str,
+        personality_id: str = None,
+        all_personalities: bool = False
+    ) -> List[Dict]:
+        """
+        Async version of run_targeted_test.
+
+        Conversations for the different personalities run concurrently (at
+        most `concurrency` at a time); results keep the personality order.
+        """
+        scenario, personalities = self._targeted_selection(scenario_id, personality_id, all_personalities)
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def run_one(personality: Dict) -> Dict:
+            async with slots:
+                return await self.run_single_conversation_async(scenario, personality)
+
+        return list(await asyncio.gather(*(run_one(personality) for personality in personalities)))
+
+    def _targeted_selection(self, scenario_id: str, personality_id: str, all_personalities: bool):
+        """Scenario and personalities for a targeted test; raises ValueError for unknown IDs."""
         # Find scenario
-        scenario = None
-        for s in SCENARIOS:
-            if s["id"] == scenario_id:
-                scenario = s
-                break
+        scenario = get_scenario(scenario_id)
 
         if not scenario:
             raise ValueError(f"Scenario {scenario_id} not found")
 
-        results = []
-
         if all_personalities:
             # Test with all personalities
-            for personality in PERSONALITIES:
-                result = self.run_single_conversation(scenario, personality)
-                results.append(result)
+            return scenario, PERSONALITIES
+
+        # Test with specific personality
+        if personality_id:
+            personality = get_personality(personality_id)
         else:
-            # Test with specific personality
-            personality = None
-            if personality_id:
-                for p in PERSONALITIES:
-                    if p["id"] == personality_id:
-                        personality = p
-                        break
-            else:
-                personality = PERSONALITIES[0]  # Default to first
-
-            if not personality:
-                raise ValueError(f"Personality {personality_id} not found")
-
-            result = self.run_single_conversation(scenario, personality)
-            results.append(result)
+            personality = PERSONALITIES[0]  # Default to first
 
-        return results
+        if not personality:
+            raise ValueError(f"Personality {personality_id} not found")
+
+        return scenario, [personality]
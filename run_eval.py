@@ -4,17 +4,112 @@ Command-line interface for running evaluations.
 """
 
 import argparse
-import json
+import asyncio
 import os
+import sys
+from typing import TYPE_CHECKING
+
 from dotenv import load_dotenv
 
-from orchestrator.simulator import EvaluationOrchestrator
-from orchestrator.reporter import EvaluationReporter
-from config.scenarios import SCENARIOS, PERSONALITIES, get_scenario, get_personality
+from config.scenarios import (
+    SCENARIOS, PERSONALITIES, PERSONALITIES_LIST_TEXT, SCENARIOS_LIST_TEXT, get_scenario, get_personality
+)
+
+# The orchestrator and reporter (and through them the Anthropic SDK, httpx
+# and numpy) are imported only by the subcommands that run simulations, so
+# listing and --help stay fast
+if TYPE_CHECKING:
+    from orchestrator.simulator import EvaluationOrchestrator
+    from orchestrator.reporter import EvaluationReporter
 
 # Load environment variables
 load_dotenv()
 
+# Valid --scenario / --personality values, checked by argparse before any
+# API setup
+_SCENARIO_IDS = tuple(scenario["id"] for scenario in SCENARIOS)
+_PERSONALITY_IDS = tuple(personality["id"] for personality in PERSONALITIES)
+
+# Transcript speaker labels; any non-user role prints as AGENT
+_ROLE_LABEL = {"user": "USER", "assistant": "AGENT"}
+
+
+def check_api_key() -> bool:
+    """Whether ANTHROPIC_API_KEY is set; prints setup instructions if not."""
+    if not os.getenv("ANTHROPIC_API_KEY"):
+        print("Error: ANTHROPIC_API_KEY not set in environment")
+        print("Please create a .env file with your API key or set the environment variable")
+        return False
+    return True
+
+
+def create_evaluation(args):
+    """Import and construct the orchestrator and reporter for a simulation subcommand."""
+    from orchestrator.simulator import EvaluationOrchestrator
+    from orchestrator.reporter import EvaluationReporter
+
+    orchestrator = EvaluationOrchestrator(
+        requests_per_minute=getattr(args, "rpm", None),
+        input_tokens_per_minute=getattr(args, "itpm", None)
+    )
+    return orchestrator, EvaluationReporter()
+
+
+def run_async(coro):
+    """asyncio.run, on uvloop's faster event loop when it is installed."""
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(coro)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(coro)
+
+
+def write_report(report: bytes):
+    """Print an already encoded report (and a trailing newline) to stdout."""
+    sys.stdout.flush()
+    sys.stdout.buffer.write(report + b"\n")
+    sys.stdout.buffer.flush()
+
+
+async def run_batch(orchestrator: "EvaluationOrchestrator", reporter: "EvaluationReporter", args):
+    """
+    Stream a batch: each result is written to --output (a JSON array, or
+    JSON Lines for a .jsonl path) and folded into the reporter's running
+    totals as soon as it finishes, so the full result list is never held
+    in memory.
+    """
+    async def results():
+        async for result in orchestrator.run_batch_streaming(
+            num_simulations=args.num,
+            concurrency=args.concurrency,
+            output_jsonl=args.checkpoint,
+            seed=args.seed
+        ):
+            reporter.update_incremental(result)
+            yield result
+
+    from agents.clients import close_async_clients
+
+    try:
+        if args.output:
+            await reporter.save_results_streaming_async(results(), args.output, jsonl=args.output.endswith(".jsonl"))
+        else:
+            async for _ in results():
+                pass
+    finally:
+        await close_async_clients()
+
+
+async def run_targeted(orchestrator: "EvaluationOrchestrator", **kwargs):
+    """Run a targeted test, with its conversations running concurrently."""
+    from agents.clients import close_async_clients
+
+    try:
+        return await orchestrator.run_targeted_test_async(**kwargs)
+    finally:
+        await close_async_clients()
+
 
 def main():
     parser = argparse.ArgumentParser(description="Run AI Customer Support Evaluations")
@@ -29,21 +124,26 @@ def main():
 
     # Run single simulation
     single_parser = subparsers.add_parser("single", help="Run single simulation")
-    single_parser.add_argument("--scenario", required=True, help="Scenario ID")
-    single_parser.add_argument("--personality", required=True, help="Personality ID")
+    single_parser.add_argument("--scenario", required=True, choices=_SCENARIO_IDS, metavar="ID", help="Scenario ID (see list-scenarios)")
+    single_parser.add_argument("--personality", required=True, choices=_PERSONALITY_IDS, metavar="ID", help="Personality ID (see list-personalities)")
     single_parser.add_argument("--max-turns", type=int, default=10, help="Maximum conversation turns")
     single_parser.add_argument("--output", help="Output file for results (JSON)")
 
     # Run batch simulations
     batch_parser = subparsers.add_parser("batch", help="Run batch simulations")
     batch_parser.add_argument("--num", type=int, default=100, help="Number of simulations")
-    batch_parser.add_argument("--output", help="Output file for results (JSON)")
+    batch_parser.add_argument("--output", help="Output file for results (JSON, or JSON Lines if it ends in .jsonl)")
     batch_parser.add_argument("--report", help="Output file for report (TXT)")
+    batch_parser.add_argument("--checkpoint", help="JSONL file results are appended to as they finish; completed simulations are skipped on rerun with the same --seed (required)")
+    batch_parser.add_argument("--seed", type=int, help="Random seed for scenario/personality selection (reuse it to resume from --checkpoint)")
+    batch_parser.add_argument("--concurrency", type=int, help="Maximum concurrent conversations (default: 20)")
+    batch_parser.add_argument("--rpm", type=int, help="Requests-per-minute limit per API key")
+    batch_parser.add_argument("--itpm", type=int, help="Input-tokens-per-minute limit per API key")
 
     # Run targeted test
     targeted_parser = subparsers.add_parser("targeted", help="Run targeted test on specific scenario")
-    targeted_parser.add_argument("--scenario", required=True, help="Scenario ID")
-    targeted_parser.add_argument("--personality", help="Personality ID (optional)")
+    targeted_parser.add_argument("--scenario", required=True, choices=_SCENARIO_IDS, metavar="ID", help="Scenario ID (see list-scenarios)")
+    targeted_parser.add_argument("--personality", choices=_PERSONALITY_IDS, metavar="ID", help="Personality ID (optional)")
     targeted_parser.add_argument("--all-personalities", action="store_true", help="Test with all personalities")
     targeted_parser.add_argument("--output", help="Output file for results (JSON)")
 
@@ -53,41 +153,29 @@ def main():
         parser.print_help()
         return
 
-    # Check API key
-    if not os.getenv("ANTHROPIC_API_KEY"):
-        print("Error: ANTHROPIC_API_KEY not set in environment")
-        print("Please create a .env file with your API key or set the environment variable")
-        return
-
-    orchestrator = EvaluationOrchestrator()
-    reporter = EvaluationReporter()
+    # Checkpointed results are matched by per-simulation seeds derived from
+    # --seed; without it a rerun would redo (and re-append) the whole batch
+    if args.command == "batch" and args.checkpoint and args.seed is None:
+        batch_parser.error("--checkpoint requires --seed")
 
     if args.command == "list-scenarios":
-        print(f"\nAvailable Scenarios ({len(SCENARIOS)}):\n")
-        for scenario in SCENARIOS:
-            print(f"  {scenario['id']}: {scenario['type']}")
-            print(f"    Goal: {scenario['goal']}")
-            print()
+        sys.stdout.write(SCENARIOS_LIST_TEXT)
 
     elif args.command == "list-personalities":
-        print(f"\nAvailable Personalities ({len(PERSONALITIES)}):\n")
-        for personality in PERSONALITIES:
-            print(f"  {personality['id']}:")
-            print(f"    Tone: {personality['tone']}, Tech: {personality['technical_literacy']}")
-            print(f"    Formality: {personality['formality']}, Trust: {personality['trust_level']}")
-            print()
+        sys.stdout.write(PERSONALITIES_LIST_TEXT)
 
     elif args.command == "single":
         scenario = get_scenario(args.scenario)
-        if not scenario:
-            print(f"Error: Scenario '{args.scenario}' not found")
-            return
-
         personality = get_personality(args.personality)
-        if not personality:
-            print(f"Error: Personality '{args.personality}' not found")
+
+        if not check_api_key():
             return
 
+        import orjson
+        from orchestrator.reporter import RESULTS_DUMPS_OPTION, WRITE_BUFFER_SIZE
+
+        orchestrator, reporter = create_evaluation(args)
+
         print(f"\nRunning simulation: {args.scenario} with {args.personality}")
         print(f"Goal: {scenario['goal']}\n")
 
@@ -97,13 +185,12 @@ def main():
             max_turns=args.max_turns
         )
 
-        print("\n" + "=" * 80)
-        print("CONVERSATION TRANSCRIPT")
-        print("=" * 80 + "\n")
-
-        for i, msg in enumerate(result["conversation_history"]):
-            role = "USER" if msg["role"] == "user" else "AGENT"
-            print(f"{role}: {msg['content']}\n")
+        out = ["\n" + "=" * 80 + "\nCONVERSATION TRANSCRIPT\n" + "=" * 80 + "\n\n"]
+        out.extend(
+            f"{_ROLE_LABEL.get(msg['role'], 'AGENT')}: {msg['content']}\n\n"
+            for msg in result["conversation_history"]
+        )
+        sys.stdout.write("".join(out))
 
         print("=" * 80)
         print("EVALUATION RESULTS")
@@ -117,51 +204,53 @@ def main():
         print(f"Turns: {result['turns']}")
 
         if args.output:
-            with open(args.output, 'w') as f:
-                json.dump(result, f, indent=2)
+            with open(args.output, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2 | RESULTS_DUMPS_OPTION))
             print(f"\nResults saved to {args.output}")
 
     elif args.command == "batch":
+        if not check_api_key():
+            return
+        orchestrator, reporter = create_evaluation(args)
+
         print(f"\nRunning {args.num} simulations...\n")
 
-        results = orchestrator.run_batch_simulations(num_simulations=args.num)
+        run_async(run_batch(orchestrator, reporter, args))
 
         print("\nGenerating report...\n")
-        report = reporter.generate_report(results)
-        print(report)
+        report = reporter.generate_report_bytes([], output_file=args.report, aggregated=reporter.aggregate_state())
+        write_report(report)
 
         if args.output:
-            reporter.save_results(results, args.output)
             print(f"\nResults saved to {args.output}")
 
         if args.report:
-            with open(args.report, 'w') as f:
-                f.write(report)
             print(f"Report saved to {args.report}")
 
     elif args.command == "targeted":
-        scenario = get_scenario(args.scenario)
-        if not scenario:
-            print(f"Error: Scenario '{args.scenario}' not found")
+        if not check_api_key():
             return
+        orchestrator, reporter = create_evaluation(args)
 
         if args.all_personalities:
             print(f"\nRunning targeted test: {args.scenario} with ALL personalities\n")
-            results = orchestrator.run_targeted_test(
+            results = run_async(run_targeted(
+                orchestrator,
                 scenario_id=args.scenario,
                 all_personalities=True
-            )
+            ))
         else:
             personality_id = args.personality or PERSONALITIES[0]["id"]
             print(f"\nRunning targeted test: {args.scenario} with {personality_id}\n")
-            results = orchestrator.run_targeted_test(
+            results = run_async(run_targeted(
+                orchestrator,
                 scenario_id=args.scenario,
                 personality_id=personality_id
-            )
+            ))
 
         print("\nGenerating report...\n")
-        report = reporter.generate_report(results)
-        print(report)
+        report = reporter.generate_report_bytes(results)
+        write_report(report)
 
         if args.output:
             reporter.save_results(results, args.output)